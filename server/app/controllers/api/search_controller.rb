@@ -20,6 +20,9 @@ module Api
     #   page        | number  | The page of images to get
     #   page_size   | number  | The number of images per page
     #   color       | string  | Filter by a particular color theme.
+    #   min_color_coverage | number | Minimum percentage of the image
+    #                             covered by +color+, which must be one
+    #                             of the histogram's colors.
     #   people      | boolean | Filter for images with people.
     #   num_people  | number  | Specify the number of people the look for.
     #   min_height  | number  | Minimum image width in pixels
@@ -50,6 +53,7 @@ module Api
           key :page, is: integer?
           key :page_size, is: integer?
           key :color, is: in?(ALLOWED_COLORS)
+          key :min_color_coverage, is: integer?(range: (1..100))
           key :people, is: boolean?
           key :num_people, is: integer?
           key :min_height, is: integer?
@@ -61,6 +65,10 @@ module Api
       params = Utils.symbolize(request.query_parameters)
 
       raise HttpError, 400 unless valid_params.call(params)
+      # the histogram has no grayscale, only the colors the tagger emits
+      if params[:min_color_coverage] && !Image::COLOR_TYPES.include?(params[:color])
+        raise HttpError, 400
+      end
       {
         page: params.fetch(:page, "1").to_i,
         page_size: params.fetch(:page_size, "20")&.to_i,
@@ -69,6 +77,7 @@ module Api
         num_people: params.fetch(:num_people, nil)&.to_i,
         people: to_bool.call(params.fetch(:people, nil)),
         color: params.fetch(:color, nil),
+        min_color_coverage: params.fetch(:min_color_coverage, nil)&.to_i,
         orientation: params.fetch(:orientation, nil)
       }
     end
@@ -2,6 +2,13 @@ class Image < ApplicationRecord
   include Elasticsearch::Model
   include Elasticsearch::Model::Callbacks
 
+  # the colors of the histogram the tagger generates
+  COLOR_TYPES = %w[
+    black white red orange amber
+    yellow lime green teal turquoise
+    aqua azure blue purple orchid magenta
+  ]
+
   has_many :tags, dependent: :destroy
   self.implicit_order_column = :created_at
   default_scope { order(created_at: :desc) }
@@ -20,6 +27,11 @@ class Image < ApplicationRecord
       indexes :url, type: :text
       indexes :published_at, type: :date
 
+      # the fraction of the image covered by each color
+      indexes :colors, type: :object do
+        COLOR_TYPES.each { |color| indexes color, type: :float }
+      end
+
       indexes :tags, type: :nested do
         indexes :kind, type: :text
         indexes :value, type: :text, analyzer: "english"
@@ -91,6 +103,7 @@ class Image < ApplicationRecord
       orientation: orientation,
       url: thumbnail_url,
       published_at: published_at.to_datetime,
+      colors: colors,
       tags: tag_objs
     }
   end
@@ -9,8 +9,7 @@ module ImageService
   # @return [String] The path of the saved image.
   def self.save_image(name, ext, data)
     path = File.join($image_dir, name + ext)
-    f = File.new(path, "wb")
-    f.write(data)
+    File.open(path, "wb") { |f| f.write(data) }
     path
   end
 
@@ -19,6 +18,7 @@ module ImageService
     image_size = ImageSize.new(data)
     w = image_size.width
     h = image_size.height
+    return { width: nil, height: nil, orientation: nil, tags: [] } if w.nil? || h.nil?
 
     wh = w / h
     hw = h / w
@@ -37,45 +37,41 @@ module ImageService
   # @param files [Array<ActionDispatch::Http::UploadedFile>]
   # @return [Array<Image>]
   def self.upload_images(files)
-    threads =
+    objs =
       files.map do |file|
-        Thread.new {
-          id = SecureRandom.alphanumeric($id_length)
-          file_name = file.original_filename
-          data = file.read
-          path = save_image(id, File.extname(file_name), data)
+        id = SecureRandom.alphanumeric($id_length)
+        file_name = file.original_filename
+        data = file.read
+        path = save_image(id, File.extname(file_name), data)
 
-          obj = {
-            id: id,
-            data: data,
-            path: path,
-            file_name: file_name,
-            file_size: file.size,
-            mime_type: file.content_type,
-          }
-
-          # get the image width, height, orientation and tags
-          begin
-            extra = TagService.tag_image(file.original_filename.to_s, data)
-          rescue HttpError => e
-            Rails.logger.error "Failed to tag image - status code #{e.code}"
-            Rails.logger.info ">> Falling back"
-
-            # fallback to the image_size gem to find the width
-            # height and orientation of the image. No tags this
-            # way unfortunately.
-            extra = get_dimensions(data)
-          end
-
-          Thread.current[:obj] = obj.merge(extra)
+        {
+          id: id,
+          data: data,
+          path: path,
+          file_name: file_name,
+          file_size: file.size,
+          mime_type: file.content_type,
         }
       end
 
-    objs = threads.map do |t|
-      t.join
-      t[:obj]
+    # get the image width, height, orientation and tags for
+    # all of the images with a single request to the tagger
+    begin
+      extras = TagService.tag_images(objs.map { |obj| obj[:path] })
+      # images the tagger couldn't decode fall back on their own
+      extras = extras.zip(objs).map { |extra, obj| extra || get_dimensions(obj[:data]) }
+    rescue HttpError => e
+      Rails.logger.error "Failed to tag images - status code #{e.code}"
+      Rails.logger.info ">> Falling back"
+
+      # fallback to the image_size gem to find the width
+      # height and orientation of the images. No tags this
+      # way unfortunately.
+      extras = objs.map { |obj| get_dimensions(obj[:data]) }
     end
 
+    objs = objs.zip(extras).map { |obj, extra| obj.merge(extra) }
+
     # curb tries to send this as a multipart form-data request without
     # the explicit headers/json serialization
     paths = objs.map { |obj| obj[:path] }
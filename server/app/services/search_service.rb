@@ -45,6 +45,19 @@ module SearchService
               end
             end
 
+            if options[:color] && options[:min_color_coverage]
+              element do
+                # colors is a plain object, not a nested field
+                shortform_query({
+                  "colors.#{options[:color]}" => {
+                    type: "range",
+                    op: "gte",
+                    value: options[:min_color_coverage] / 100.0
+                  }
+                }, nested: true)
+              end
+            end
+
             if options[:people]
               element do
                 shortform_query({
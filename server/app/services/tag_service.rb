@@ -2,6 +2,7 @@ require "curb"
 require "json"
 
 TAGGER_URL = "http://localhost/api/tagger"
+TAGGER_BATCH_SIZE = 32
 
 module TagService
   # Generates tags for an image using the tagger server
@@ -19,13 +20,30 @@ module TagService
     c.http_post(file)
     raise HttpError, c.response_code unless c.response_code == 200
     res = JSON.parse(c.body_str, symbolize_names: true)
+    make_image_info(res)
+  end
 
-    {
-      width: res[:width],
-      height: res[:height],
-      orientation: res[:orientation],
-      tags: res[:tags].map { |tag| make_tag_obj(tag) }.flatten
-    }
+  # Generates tags for a number of images that have already been
+  # saved to disk using a single request to the tagger server.
+  # @param paths [Array<String>] The image paths.
+  # @return [Array<Hash, nil>] Image information for each path, or
+  #   +nil+ for images the tagger couldn't decode
+  def self.tag_images(paths)
+    paths.each_slice(TAGGER_BATCH_SIZE).flat_map do |slice|
+      c = Curl::Easy.new(File.join(TAGGER_URL, "batch"))
+      c.headers["Content-Type"] = "application/json"
+      c.http_post(slice.to_json)
+      raise HttpError, c.response_code unless c.response_code == 200
+      res = JSON.parse(c.body_str, symbolize_names: true)
+      res.map do |obj|
+        if obj[:error]
+          Rails.logger.error "Failed to tag image - #{obj[:error]}"
+          nil
+        else
+          make_image_info(obj)
+        end
+      end
+    end
   end
 
   # @param image [Image]
@@ -48,6 +66,18 @@ module TagService
     c.response_code == 200
   end
 
+  # @param obj [Hash] Tagger result object.
+  # @return [Hash]
+  def self.make_image_info(obj)
+    {
+      width: obj[:width],
+      height: obj[:height],
+      orientation: obj[:orientation],
+      colors: obj[:colors],
+      tags: obj[:tags].map { |tag| make_tag_obj(tag) }.flatten
+    }
+  end
+
   # @param obj [Hash] Tag object.
   # @return [Hash, Array<Hash>]
   def self.make_tag_obj(obj)
@@ -0,0 +1,5 @@
+class AddColorsToImages < ActiveRecord::Migration[6.1]
+  def change
+    add_column :images, :colors, :jsonb
+  end
+end
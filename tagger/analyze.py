@@ -1,15 +1,27 @@
-from typing import Tuple, List
+from typing import Any, Callable, Dict, Tuple, List, Optional, Union
 from timeit import default_timer as timer
 
 import cv2
 
-from common.types import ImageData, Tag, TagType, Orientation
+from common.types import DecodeError, ImageData, Tag, TagType, Orientation
 from model.dataset import Label
-from predict import run_predict, NetResults
-from color import Colors, extract_palette, Color
+from predict import run_predict, run_predict_batch, select_crops, NetResults, PredictResults
+from model.models import BoxResult
+from box import Box
+from color import ColorLUT, extract_palette, palette_bins, palette_from_bins, Color
+from functools import lru_cache
+from collections import Counter
+from cache import ResultCache
+from duplicates import DuplicateIndex, dhash
 from common import utils
 import numpy as np
+import metrics
+import logging
+import config
 import math
+import os
+
+log = logging.getLogger(__name__)
 
 
 KEYWORD_FILTER = [
@@ -17,6 +29,31 @@ KEYWORD_FILTER = [
   'structure',
 ]
 
+# the number of colors in the palette of each detected subject
+SUBJECT_PALETTE_SIZE = 3
+
+# bumped whenever the fields of an analysis change
+ANALYSIS_VERSION = 5
+
+CACHE_VERSION = ':'.join(map(str, [
+  ANALYSIS_VERSION, config.MODEL_VERSION, config.MAX_CROPS, config.CROP_MIN_AREA, config.CROP_MERGE_IOU,
+  config.CROP_GROUP_SIZE, config.DECODE_MIN_SIZE, int(config.COLOR_TAGS), config.REGION_COLORS,
+]))
+
+cache = ResultCache(CACHE_VERSION, config.CACHE_SIZE, config.CACHE_PATH or None, config.CACHE_DISK_SIZE)
+duplicates = DuplicateIndex(config.CACHE_PATH or None, config.CACHE_DISK_SIZE)
+
+metrics.Counter('tagger_cache_hits_total', 'Results found in the cache', fn=lambda: cache.hits)
+metrics.Counter('tagger_cache_misses_total', 'Results not found in the cache', fn=lambda: cache.misses)
+metrics.Counter('tagger_duplicates_reused_total', 'Results reused from a near-duplicate',
+                fn=lambda: duplicates.reused)
+
+
+@lru_cache(maxsize=None)
+def get_color_lut() -> ColorLUT:
+  # built (or loaded) on first use since building takes a few seconds
+  return ColorLUT.load(config.COLOR_LUT_PATH or None, config.COLOR_LUT_BITS)
+
 
 def add_bias(bias: float, value: float) -> float:
   return max(0.0, min(bias + value, 1.0))
@@ -34,8 +71,8 @@ def count_instances(results: NetResults) -> Tuple[dict, dict]:
 
 
 def group_labels(labels: List[Label]) -> List[Tuple[Label, int]]:
-  unique = list(utils.unique(labels))
-  return [(l, labels.count(l)) for l in unique]
+  # counters keep the order labels were first seen in
+  return list(Counter(labels).items())
 
 
 def labels_to_tags(labels: List[Label]) -> List[Tag]:
@@ -55,8 +92,8 @@ def labels_to_tags(labels: List[Label]) -> List[Tag]:
   return tags
 
 
-def colors_to_tags(colors: List[Color]) -> List[Tag]:
-  print('colors', colors)
+def colors_to_tags(colors: List[Color], coverage: Dict[str, float]) -> List[Tag]:
+  log.debug(f'colors {colors}')
 
   def is_grayscale(c: Color) -> bool:
     return False
@@ -68,11 +105,14 @@ def colors_to_tags(colors: List[Color]) -> List[Tag]:
     return [Tag(TagType.COLOR, 'bw')]
 
   colors = [c for c in colors if not is_grayscale(c)]
-  return [Tag(TagType.COLOR, str(c)) for c in colors]
+  # shades of a color share its name, the most dominant color comes first
+  names = sorted(utils.unique([str(c) for c in colors]), key=lambda name: -coverage[name])
+  return [Tag(TagType.COLOR, name) for name in names]
 
 
-def get_image_info(img: np.ndarray) -> Tuple[int, int, Orientation]:
-  h, w = img.shape[:2]
+def get_image_info(img: ImageData) -> Tuple[int, int, Orientation]:
+  # the dimensions of the file, the image may have been decoded smaller
+  w, h = img.width, img.height
   wh = w / h
   hw = h / w
   diff = abs(wh - hw)
@@ -104,7 +144,7 @@ def analyze_results(results: NetResults):
     # print('')
 
     threshold = 0.25
-    if x.classes == y.classes:
+    if x == y:
       # x and y are identical
       pass
     elif x.is_parent(y) and xc >= threshold:
@@ -137,10 +177,7 @@ def analyze_results(results: NetResults):
   return labels_to_tags(labels)
 
 
-def analyze_colors(img: np.ndarray) -> List[Tag]:
-  img = img[:, :, ::-1]
-  target = 1000
-
+def downscale_for_colors(img: np.ndarray, target: int = 1000) -> np.ndarray:
   h, w = img.shape[:2]
   if w > target and w > h:
     img = utils.resize(img, width=target)
@@ -148,10 +185,107 @@ def analyze_colors(img: np.ndarray) -> List[Tag]:
     img = utils.resize(img, height=target)
   elif w > target and h > target:
     img = utils.resize(img, width=target, height=target)
+  return img
+
+
+@metrics.stage('colors')
+def analyze_colors(img: np.ndarray, with_tags: bool = True) -> Tuple[List[Tag], Dict[str, float]]:
+  """
+  Returns the color tags of a downscaled image along with
+  the fraction of its pixels that are of each color type.
+  The palette is only extracted when `with_tags` is set.
+  """
+  lut = get_color_lut()
+  coverage = {k: round(v, 4) for k, v in lut.coverage_by_type(img).items()}
+  if not with_tags:
+    return [], coverage
+  colors = lut.find_closest(extract_palette(img))
+  return colors_to_tags(colors, coverage), coverage
+
+
+@metrics.stage('regions')
+def analyze_regions(img: np.ndarray, results: PredictResults, scale: float) -> Optional[dict]:
+  """
+  Returns the colors of the largest subjects yolo found in a downscaled
+  image and of the background around all of them. The image is quantized
+  once and every region is a view or a mask of it, so nothing is cropped
+  out of the full image or decoded again.
+
+  :param scale: The size of `img` relative to the image that was analyzed.
+  """
+  boxes = [a.bbox for a, _ in results if isinstance(a, BoxResult)]
+  if len(boxes) == 0:
+    return None
+
+  def color_names(bins: np.ndarray, num_colors: int = 5) -> List[str]:
+    # every 10th pixel is sampled like `extract_palette` does
+    colors = get_color_lut().find_closest(palette_from_bins(bins.ravel()[::10], num_colors))
+    return list(utils.unique([str(c) for c in colors]))
 
-  colors = extract_palette(img)
-  colors = [Colors.find_closest(c) for c in colors]
-  return colors_to_tags(colors)
+  bins = palette_bins(img)
+  background = np.ones(bins.shape, dtype=bool)
+  for bbox in boxes:
+    Box([p * scale for p in bbox.points]).crop(background)[:] = False
+
+  subjects = []
+  for r in select_crops([a for a, _ in results], config.REGION_COLORS):
+    region = Box([p * scale for p in r.bbox.points]).crop(bins)
+    subjects += [{'label': r.label.name, 'colors': color_names(region, SUBJECT_PALETTE_SIZE)}]
+
+  return {
+    'subjects': subjects,
+    'background': color_names(bins[background]),
+  }
+
+
+def find_cached(img: ImageData, key: str, phash: int) -> Optional[dict]:
+  """
+  Returns the cached analysis of an image. If the image itself has not
+  been analyzed before and `DUPLICATE_DISTANCE` is set, the tags of a
+  near-duplicate (the same image at a different size or quality) are
+  reused instead.
+  """
+  analysis = cache.get(key)
+  if analysis is not None or config.DUPLICATE_DISTANCE <= 0:
+    return analysis
+
+  for _, duplicate in duplicates.search(phash, config.DUPLICATE_DISTANCE):
+    analysis = cache.get(duplicate.key, record=False)
+    if analysis is None:
+      # the result was evicted from the cache
+      duplicates.remove(duplicate.key)
+      continue
+
+    # only the tags are shared, the dimensions belong to this image
+    width, height, orientation = get_image_info(img)
+    analysis.update(width=width, height=height, orientation=orientation)
+    duplicates.record_reuse()
+    cache.put(key, analysis)
+    return analysis
+
+  return None
+
+
+def make_analysis(img: ImageData, results: PredictResults) -> dict:
+  with metrics.stage('analyze_results'):
+    tags = analyze_results(results)
+  # the histogram is always computed so images can be searched by color coverage
+  small = downscale_for_colors(img.data)
+  color_tags, colors = analyze_colors(small, config.COLOR_TAGS)
+  tags += color_tags
+  regions = None
+  if config.REGION_COLORS > 0:
+    regions = analyze_regions(small, results, small.shape[1] / img.data.shape[1])
+
+  width, height, orientation = get_image_info(img)
+  return {
+    'width': width,
+    'height': height,
+    'orientation': orientation,
+    'tags': tags,
+    'colors': colors,
+    'regions': regions
+  }
 
 
 def run_analysis(img: ImageData) -> dict:
@@ -161,31 +295,145 @@ def run_analysis(img: ImageData) -> dict:
   :param img:
   :return:
   """
-  tags = []
+  key = cache.key(img)
+  phash = dhash(img.data)
+  cached = find_cached(img, key, phash)
+  if cached is not None:
+    log.debug(f'Cache hit for {img.file_name}')
+    duplicates.add(phash, key, img.file_name)
+    return cached
 
   a_start = timer()
   results = run_predict(img.data)
   a_end = timer()
 
   b_start = timer()
-  tags += analyze_results(results)
-  # tags += analyze_colors(img.data)
+  analysis = make_analysis(img, results)
   b_end = timer()
 
-  width, height, orientation = get_image_info(img.data)
+  log.debug(f'Analyzed {img.file_name} | width: {analysis["width"]} | height: {analysis["height"]} | '
+            f'orientation: {analysis["orientation"]} | tags: {analysis["tags"]}')
+  log.debug(f'Inference took {a_end - a_start} seconds')
+  log.debug(f'Analysis took {b_end - b_start} seconds')
 
-  print('----- Analysis Results -----')
-  print(f'width: {width} | height: {height} | orientation: {orientation}')
-  for tag in tags:
-    print(tag)
-  print('----------------------------')
-  print(f'Inference took {a_end - a_start} seconds')
-  print(f'Analysis took {b_end - b_start} seconds')
-  print('')
+  cache.put(key, analysis)
+  duplicates.add(phash, key, img.file_name)
+  return analysis
+
+
+def run_analysis_batch(imgs: List[ImageData]) -> List[dict]:
+  """
+  Analyzes a number of images at once. The images are run through
+  the models together so they share as many forward passes as possible.
+
+  :param imgs:
+  :return: The analysis results for each image.
+  """
+  keys = [cache.key(img) for img in imgs]
+  phashes = [dhash(img.data) for img in imgs]
+  analyses = [find_cached(*args) for args in zip(imgs, keys, phashes)]
+  misses = [i for i, analysis in enumerate(analyses) if analysis is None]
+  if len(misses) == 0:
+    for img, key, phash in zip(imgs, keys, phashes):
+      duplicates.add(phash, key, img.file_name)
+    return analyses
+
+  a_start = timer()
+  batch_results = run_predict_batch([imgs[i].data for i in misses])
+  a_end = timer()
+
+  b_start = timer()
+  for i, results in zip(misses, batch_results):
+    analyses[i] = make_analysis(imgs[i], results)
+    cache.put(keys[i], analyses[i])
+  b_end = timer()
+
+  for img, key, phash in zip(imgs, keys, phashes):
+    duplicates.add(phash, key, img.file_name)
+
+  log.debug(f'Batch inference on {len(misses)} of {len(imgs)} images took {a_end - a_start} seconds')
+  log.debug(f'Batch analysis took {b_end - b_start} seconds')
+
+  return analyses
+
+
+def decode_file(file: Union[dict, ImageData]) -> ImageData:
+  # uploads may have already been decoded while they were streamed in
+  if isinstance(file, ImageData):
+    return file
+  with metrics.stage('decode'):
+    try:
+      return ImageData(file, config.DECODE_MIN_SIZE)
+    except (OSError, ValueError, cv2.error) as e:
+      raise DecodeError(f'could not decode {file["filename"]}') from e
+
+
+def decode_path(path: str) -> ImageData:
+  with metrics.stage('decode'):
+    try:
+      return ImageData.from_path(path, config.DECODE_MIN_SIZE)
+    except (OSError, ValueError, cv2.error) as e:
+      raise DecodeError(f'could not decode {os.path.basename(path)}') from e
+
+
+def analyze_file(file: Union[dict, ImageData]) -> dict:
+  """
+  Decodes and analyzes an uploaded file. This is the entry
+  point used by the inference executor so the decode happens
+  off of the IOLoop as well.
+
+  :param file: A dict with the `filename`, `content_type` and `body` of the upload,
+               or the upload already decoded.
+  :return: The analysis results.
+  """
+  return run_analysis(decode_file(file))
+
+
+def try_decode(decode: Callable[[Any], ImageData], item: Any) -> Union[ImageData, DecodeError]:
+  # images that failed to decode while they were streamed in are passed on as the error
+  if isinstance(item, DecodeError):
+    return item
+  try:
+    return decode(item)
+  except DecodeError as e:
+    return e
+
+
+def run_decoded(decoded: List[Union[ImageData, DecodeError]], fn: Callable[[List[ImageData]], list]) -> list:
+  """
+  Runs `fn` on the images that were decoded and returns its results in
+  order, with an `{ error }` entry in place of each image that wasn't.
+  """
+  results = iter(fn([d for d in decoded if isinstance(d, ImageData)]))
+  return [{'error': str(d)} if isinstance(d, DecodeError) else next(results) for d in decoded]
+
+
+def analyze_files(files: List[Union[dict, ImageData, DecodeError]]) -> List[dict]:
+  return run_decoded([try_decode(decode_file, file) for file in files], run_analysis_batch)
+
+
+def analyze_paths(paths: List[str]) -> List[dict]:
+  return run_decoded([try_decode(decode_path, path) for path in paths], run_analysis_batch)
+
+
+def find_duplicates(imgs: List[ImageData], distance: int) -> List[List[dict]]:
+  """
+  Returns the previously analyzed images that are near-duplicates of
+  each of the given images, closest first.
+  """
+  matches = []
+  for img in imgs:
+    found = duplicates.search(dhash(img.data), distance)
+    matches += [[{'name': d.name, 'distance': dist} for dist, d in found]]
+  return matches
+
+
+def find_duplicate_files(files: List[Union[dict, ImageData, DecodeError]], distance: int) -> List[list]:
+  return run_decoded([try_decode(decode_file, file) for file in files],
+                     lambda imgs: find_duplicates(imgs, distance))
+
+
+def find_duplicate_paths(paths: List[str], distance: int) -> List[list]:
+  return run_decoded([try_decode(decode_path, path) for path in paths],
+                     lambda imgs: find_duplicates(imgs, distance))
 
-  return {
-    'width': width,
-    'height': height,
-    'orientation': orientation,
-    'tags': tags
-  }
@@ -0,0 +1,125 @@
+from typing import Any, Callable, List, Optional, Tuple
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread, Lock
+from timeit import default_timer as timer
+import metrics
+import os
+
+BatchFn = Callable[[List[Any]], List[Any]]
+
+
+class BatchScheduler(object):
+  """
+  Collects items submitted from any number of threads and runs
+  them through `fn` together. A batch is dispatched as soon as it
+  holds `max_size` items or `max_delay` milliseconds after its first
+  item arrived, whichever comes first. `fn` must return one result
+  per item, in the same order, and each result is routed back to
+  the future of the request that submitted the item.
+  """
+  __fn: BatchFn
+  __max_size: int
+  __max_delay: float
+  __name: str
+  __queue: Optional[Queue]
+  __thread: Optional[Thread]
+  __pid: int
+  __lock: Lock
+  __batch_size: metrics.Histogram
+  __queue_depth: metrics.Gauge
+
+  def __init__(self, fn: BatchFn, max_size: int = 8, max_delay: float = 10, name: str = None):
+    assert max_size > 0 and max_delay >= 0
+
+    self.__fn = fn
+    self.__max_size = max_size
+    self.__max_delay = max_delay / 1000
+    self.__name = name or 'batch-scheduler'
+    self.__queue = None
+    self.__thread = None
+    self.__pid = -1
+    self.__lock = Lock()
+
+    labels = {'model': self.__name.lower()}
+    self.__batch_size = metrics.Histogram('tagger_batch_size', 'Number of items run in each batch',
+                                          labels, [1, 2, 4, 8, 16, 32, 64])
+    self.__queue_depth = metrics.Gauge('tagger_batch_queue_depth',
+                                       'Items left waiting after the last batch was collected', labels)
+
+  #
+
+  def submit(self, item: Any) -> Future:
+    """
+    Adds an item to the next batch and returns a future
+    that resolves to the item's result.
+    """
+    future = Future()
+    self.__get_queue().put((item, future))
+    return future
+
+  def submit_many(self, items: List[Any]) -> List[Future]:
+    queue = self.__get_queue()
+    futures = []
+    for item in items:
+      future = Future()
+      queue.put((item, future))
+      futures += [future]
+    return futures
+
+  def run(self, item: Any) -> Any:
+    """
+    Submits an item and blocks until its result is ready.
+    """
+    return self.submit(item).result()
+
+  def run_many(self, items: List[Any]) -> List[Any]:
+    return [f.result() for f in self.submit_many(items)]
+
+  # private methods
+
+  def __get_queue(self) -> Queue:
+    # the worker thread is started lazily and restarted after
+    # a fork, because threads are not copied into child processes.
+    with self.__lock:
+      if self.__pid != os.getpid():
+        self.__pid = os.getpid()
+        self.__queue = Queue()
+        self.__thread = Thread(target=self.__run, args=(self.__queue,),
+                               name=self.__name, daemon=True)
+        self.__thread.start()
+      return self.__queue
+
+  def __collect(self, queue: Queue) -> List[Tuple[Any, Future]]:
+    batch = [queue.get()]
+    deadline = timer() + self.__max_delay
+    while len(batch) < self.__max_size:
+      remaining = deadline - timer()
+      try:
+        if remaining > 0:
+          batch += [queue.get(timeout=remaining)]
+        else:
+          batch += [queue.get_nowait()]
+      except Empty:
+        break
+    return batch
+
+  def __run(self, queue: Queue):
+    while True:
+      batch = self.__collect(queue)
+      self.__batch_size.observe(len(batch))
+      self.__queue_depth.set(queue.qsize())
+
+      items = [item for item, _ in batch]
+      futures = [future for _, future in batch]
+
+      try:
+        results = self.__fn(items)
+        assert len(results) == len(items)
+      except BaseException as e:
+        for future in futures:
+          future.set_exception(e)
+        continue
+
+      for future, result in zip(futures, results):
+        future.set_result(result)
@@ -0,0 +1,280 @@
+"""
+Benchmarks the tagger's analysis pipeline. Run from the tagger directory:
+  python -m benchmarks.analysis run [--folder <images>] [--url <tagger url>] [--output results.json]
+  python -m benchmarks.analysis compare <before.json> <after.json>
+
+Images are either read from a folder or generated at each of `--sizes`.
+They're analyzed in process with `analyze.analyze_file` (with stub models
+unless `--models real` is given) or, when `--url` is given, posted to a
+running tagger. Every workload is run at each of the `--concurrency` levels
+and the latency percentiles, throughput and peak RSS are printed and
+optionally saved as json so that two runs can be compared.
+
+The result cache is disabled when running in process. A tagger that's
+benchmarked over http should be started with `TAGGER_CACHE_SIZE=0`,
+`TAGGER_CACHE_PATH=` and `TAGGER_DUPLICATE_DISTANCE=0` for the same reason.
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+import urllib.request
+import numpy as np
+import subprocess
+import mimetypes
+import resource
+import argparse
+import datetime
+import uuid
+import json
+import cv2
+import os
+
+# (name, content type, body) of an image file
+File = Tuple[str, str, bytes]
+
+
+#
+# Workloads
+#
+
+def synthetic_image(width: int, height: int, seed: int = 0) -> bytes:
+  """
+  A jpeg of smooth random color blobs with some noise on top, so it
+  compresses (and decodes) more like a photo than pure noise would.
+  """
+  rng = np.random.RandomState(seed)
+  blobs = rng.randint(0, 256, (6, 8, 3)).astype(np.uint8)
+  img = cv2.resize(blobs, (width, height), interpolation=cv2.INTER_CUBIC)
+  noise = rng.randint(-8, 9, img.shape)
+  img = np.clip(img.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+  return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+def synthetic_workloads(sizes: List[str]) -> Dict[str, List[File]]:
+  workloads = {}
+  for size in sizes:
+    width, height = map(int, size.lower().split('x'))
+    files = [(f'{size}-{i}.jpg', 'image/jpeg', synthetic_image(width, height, i)) for i in range(4)]
+    workloads[size] = files
+  return workloads
+
+
+def folder_workload(folder: str, limit: int) -> Dict[str, List[File]]:
+  files = []
+  for name in sorted(os.listdir(folder)):
+    content_type = mimetypes.guess_type(name)[0]
+    if content_type not in ['image/gif', 'image/jpeg', 'image/png', 'image/webp']:
+      continue
+
+    with open(os.path.join(folder, name), 'rb') as f:
+      files += [(name, content_type, f.read())]
+    if len(files) >= limit:
+      break
+
+  if len(files) == 0:
+    raise ValueError(f'no images found in {folder}')
+  return {os.path.basename(os.path.normpath(folder)): files}
+
+
+#
+# Runners
+#
+
+def make_direct_runner(models: str) -> Callable[[File], None]:
+  # the environment is set up before the tagger is imported
+  # since its configuration is read at import time.
+  os.environ['TAGGER_CACHE_SIZE'] = '0'
+  os.environ['TAGGER_CACHE_PATH'] = ''
+  os.environ['TAGGER_DUPLICATE_DISTANCE'] = '0'
+
+  from model.models import registry
+  import analyze
+  import threads
+
+  threads.configure()
+  if models == 'stub':
+    from benchmarks import stubs
+    stubs.install()
+  registry.load()
+
+  def run(file: File):
+    name, content_type, body = file
+    analyze.analyze_file({'filename': name, 'content_type': content_type, 'body': body})
+  return run
+
+
+def make_http_runner(url: str) -> Callable[[File], None]:
+  def run(file: File):
+    name, content_type, body = file
+    boundary = uuid.uuid4().hex
+    data = b''.join([
+      f'--{boundary}\r\n'.encode(),
+      f'Content-Disposition: form-data; name="file"; filename="{name}"\r\n'.encode(),
+      f'Content-Type: {content_type}\r\n\r\n'.encode(),
+      body,
+      f'\r\n--{boundary}--\r\n'.encode(),
+    ])
+
+    request = urllib.request.Request(url, data=data, method='POST', headers={
+      'Content-Type': f'multipart/form-data; boundary={boundary}',
+    })
+    with urllib.request.urlopen(request) as response:
+      response.read()
+  return run
+
+
+def peak_rss(pid: Optional[int]) -> float:
+  """
+  The peak resident set size in megabytes of this process, or of
+  `pid` when benchmarking a tagger running somewhere else.
+  """
+  if pid is None:
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+  with open(f'/proc/{pid}/status') as f:
+    for line in f:
+      if line.startswith('VmHWM:'):
+        return int(line.split()[1]) / 1024
+  return 0.0
+
+
+def measure(run: Callable[[File], None], files: List[File], concurrency: int,
+            requests: int) -> Tuple[List[float], float]:
+  """
+  Runs `requests` analyses with `concurrency` of them at a time and
+  returns the latency of each along with the total elapsed time.
+  """
+  def timed(i: int) -> float:
+    start = timer()
+    run(files[i % len(files)])
+    return timer() - start
+
+  with ThreadPoolExecutor(concurrency) as pool:
+    # one round to warm up the pool and any lazily loaded models
+    list(pool.map(timed, range(concurrency)))
+
+    start = timer()
+    latencies = list(pool.map(timed, range(requests)))
+    elapsed = timer() - start
+  return latencies, elapsed
+
+
+#
+# Results
+#
+
+def summarize(workload: str, concurrency: int, latencies: List[float],
+              elapsed: float, rss: float) -> dict:
+  p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+  return {
+    'workload': workload,
+    'concurrency': concurrency,
+    'requests': len(latencies),
+    'mean': float(np.mean(latencies)),
+    'p50': float(p50),
+    'p95': float(p95),
+    'p99': float(p99),
+    'images_per_second': len(latencies) / elapsed,
+    'peak_rss_mb': rss,
+  }
+
+
+def git_commit() -> Optional[str]:
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def print_header():
+  print(f'{"workload":<16} {"conc":>4} {"p50":>9} {"p95":>9} {"p99":>9} {"img/s":>8} {"rss":>9}')
+
+
+def print_result(r: dict):
+  print(f'{r["workload"]:<16} {r["concurrency"]:>4} {r["p50"] * 1000:>7.1f}ms {r["p95"] * 1000:>7.1f}ms '
+        f'{r["p99"] * 1000:>7.1f}ms {r["images_per_second"]:>8.2f} {r["peak_rss_mb"]:>7.1f}MB')
+
+
+def run(args: argparse.Namespace):
+  if args.folder is not None:
+    workloads = folder_workload(args.folder, args.limit)
+  else:
+    workloads = synthetic_workloads(args.sizes.split(','))
+
+  if args.url is not None:
+    runner = make_http_runner(args.url)
+  else:
+    runner = make_direct_runner(args.models)
+
+  results = []
+  print_header()
+  for workload, files in workloads.items():
+    for concurrency in map(int, args.concurrency.split(',')):
+      latencies, elapsed = measure(runner, files, concurrency, args.requests)
+      results += [summarize(workload, concurrency, latencies, elapsed, peak_rss(args.pid))]
+      print_result(results[-1])
+
+  if args.output is not None:
+    report = {
+      'commit': git_commit(),
+      'date': datetime.datetime.now().isoformat(),
+      'mode': 'http' if args.url is not None else 'direct',
+      'models': 'remote' if args.url is not None else args.models,
+      'config': {k: v for k, v in os.environ.items() if k.startswith('TAGGER_')},
+      'results': results,
+    }
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+    print(f'\nSaved results to {args.output}')
+
+
+def compare(before_path: str, after_path: str):
+  with open(before_path) as f:
+    before = json.load(f)
+  with open(after_path) as f:
+    after = json.load(f)
+
+  def change(a: float, b: float) -> str:
+    return f'{(b - a) / a:>+8.1%}' if a > 0 else f'{"n/a":>8}'
+
+  print(f'{before.get("commit") or before_path} -> {after.get("commit") or after_path}\n')
+  print(f'{"workload":<16} {"conc":>4} {"p50":>8} {"p95":>8} {"p99":>8} {"img/s":>8} {"rss":>8}')
+
+  previous = {(r['workload'], r['concurrency']): r for r in before['results']}
+  for r in after['results']:
+    a = previous.get((r['workload'], r['concurrency']))
+    if a is None:
+      continue
+    print(f'{r["workload"]:<16} {r["concurrency"]:>4} {change(a["p50"], r["p50"])} '
+          f'{change(a["p95"], r["p95"])} {change(a["p99"], r["p99"])} '
+          f'{change(a["images_per_second"], r["images_per_second"])} '
+          f'{change(a["peak_rss_mb"], r["peak_rss_mb"])}')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmarks the tagger.')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  run_parser = subparsers.add_parser('run', help='run the benchmark')
+  run_parser.add_argument('--folder', help='a folder of images to use instead of synthetic ones')
+  run_parser.add_argument('--limit', type=int, default=100, help='the most images used from the folder')
+  run_parser.add_argument('--sizes', default='640x480,1920x1080,4032x3024',
+                          help='the sizes of the synthetic images')
+  run_parser.add_argument('--concurrency', default='1,4', help='the concurrency levels to run at')
+  run_parser.add_argument('--requests', type=int, default=50, help='the images analyzed per measurement')
+  run_parser.add_argument('--models', choices=['stub', 'real'], default='stub',
+                          help='the models used when running in process')
+  run_parser.add_argument('--url', help='the url of a running tagger to benchmark over http')
+  run_parser.add_argument('--pid', type=int, help='the pid of the tagger to report the peak RSS of')
+  run_parser.add_argument('--output', help='a json file to save the results to')
+
+  compare_parser = subparsers.add_parser('compare', help='compare the results of two runs')
+  compare_parser.add_argument('before')
+  compare_parser.add_argument('after')
+
+  args = parser.parse_args()
+  if args.command == 'run':
+    run(args)
+  else:
+    compare(args.before, args.after)
@@ -0,0 +1,85 @@
+"""
+Compares the hash based `unique`, `union` and `group_labels` with the
+quadratic versions they replaced. Run from the tagger directory:
+  python -m benchmarks.labels [--sizes 10,100,1000,5000]
+
+The label lists are drawn from the imagenet labels with a few labels
+repeated many times, like the results for a crowded scene.
+"""
+from typing import Callable, Generator, List, Sequence, Tuple
+from timeit import default_timer as timer
+from model.dataset import Label
+from model.imagenet import Imagenet
+from common import utils
+import argparse
+import analyze
+import random
+
+
+def quadratic_unique(s: Sequence) -> Generator:
+  for i in range(len(s)):
+    if s[i] not in s[:i]:
+      yield s[i]
+
+
+def quadratic_union(a: Sequence, b: Sequence) -> Generator:
+  def duplicate(s: Sequence, index: int):
+    a_index = index + 1 if s is b else index
+    return (
+      s[index] in a[:min(a_index, len(a))] or
+      s[index] in b[:min(index, len(b))]
+    )
+
+  for i in range(max(len(a), len(b))):
+    if i < len(a) and not duplicate(a, i):
+      yield a[i]
+    if i < len(b) and not duplicate(b, i):
+      yield b[i]
+
+
+def quadratic_group_labels(labels: List[Label]) -> List[Tuple[Label, int]]:
+  unique = list(quadratic_unique(labels))
+  return [(l, labels.count(l)) for l in unique]
+
+
+def make_labels(size: int, seed: int = 0) -> List[Label]:
+  rng = random.Random(seed)
+  labels = [Imagenet[i] for i in range(Imagenet.size)]
+  # half of the results are one of a handful of labels
+  crowd = rng.sample(labels, 5)
+  return [rng.choice(crowd) if rng.random() < 0.5 else rng.choice(labels) for _ in range(size)]
+
+
+def measure(fn: Callable[[], object], duration: float = 0.2) -> float:
+  runs = 0
+  start = timer()
+  while timer() - start < duration:
+    fn()
+    runs += 1
+  return (timer() - start) / runs
+
+
+def bench(sizes: List[int]):
+  print(f'{"helper":<14} {"size":>6} {"before":>11} {"after":>11} {"speedup":>8}')
+
+  for size in sizes:
+    labels = make_labels(size)
+    others = make_labels(size, seed=1)
+    keywords = [k for label in labels for k in label.keywords]
+
+    cases = [
+      ('unique', lambda: list(quadratic_unique(keywords)), lambda: list(utils.unique(keywords))),
+      ('union', lambda: list(quadratic_union(labels, others)), lambda: list(utils.union(labels, others))),
+      ('group_labels', lambda: quadratic_group_labels(labels), lambda: analyze.group_labels(labels)),
+    ]
+    for name, before, after in cases:
+      assert before() == after()
+      a, b = measure(before), measure(after)
+      print(f'{name:<14} {size:>6} {a * 1000:>9.3f}ms {b * 1000:>9.3f}ms {a / b:>7.1f}x')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmarks the label helpers.')
+  parser.add_argument('--sizes', default='10,100,1000,5000', help='the lengths of the label lists')
+  args = parser.parse_args()
+  bench(list(map(int, args.sizes.split(','))))
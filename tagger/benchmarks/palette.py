@@ -0,0 +1,86 @@
+"""
+Compares the numpy palette extraction with the colorthief one it replaced.
+Run from the tagger directory:
+  python -m benchmarks.palette [--folder <images>] [--sizes 1000x750]
+
+Every image is downscaled like `analyze.analyze_colors` does before the
+palette is extracted. The time per image of both extractions is
+printed along with how many of the color tags they produce agree.
+"""
+from typing import Callable, Dict, List
+from timeit import default_timer as timer
+from colorthief import MMCQ
+from benchmarks.analysis import synthetic_workloads, folder_workload
+from color import Color, extract_palette, from_rgb
+from PIL import Image
+import numpy as np
+import argparse
+import analyze
+
+
+def colorthief_palette(img: np.ndarray, num_colors: int = 5, quality: int = 10) -> List[Color]:
+  """
+  The palette extraction from before, a python loop over the pixels
+  followed by colorthief's pure python median cut.
+  """
+  img = Image.fromarray(img).convert('RGBA')
+  w, h = img.size
+  pixels = img.getdata()
+  valid_pixels = []
+  for i in range(0, w * h, quality):
+    r, g, b, a = pixels[i]
+    if a >= 125 and not (r > 250 and g > 250 and b > 250):
+      valid_pixels.append((r, g, b))
+
+  cmap = MMCQ.quantize(valid_pixels, num_colors)
+  return list(map(lambda t: from_rgb(*t), cmap.palette))
+
+
+def color_names(colors: List[Color]) -> set:
+  return {str(c) for c in analyze.get_color_lut().find_closest(colors)}
+
+
+def measure(extract: Callable[[np.ndarray], List[Color]], imgs: List[np.ndarray],
+            repeat: int) -> float:
+  start = timer()
+  for _ in range(repeat):
+    for img in imgs:
+      extract(img)
+  return (timer() - start) / (repeat * len(imgs))
+
+
+def bench(workloads: Dict[str, list], repeat: int):
+  print(f'{"workload":<16} {"colorthief":>11} {"numpy":>9} {"speedup":>8} {"agreement":>10}')
+
+  for workload, files in workloads.items():
+    imgs = [analyze.downscale_for_colors(analyze.decode_file({
+      'filename': name, 'content_type': content_type, 'body': body,
+    }).data) for name, content_type, body in files]
+
+    before = measure(colorthief_palette, imgs, repeat)
+    after = measure(extract_palette, imgs, repeat)
+
+    # the share of tags from either extraction that both produce
+    shared, total = 0, 0
+    for img in imgs:
+      a, b = color_names(colorthief_palette(img)), color_names(extract_palette(img))
+      shared += len(a & b)
+      total += len(a | b)
+
+    print(f'{workload:<16} {before * 1000:>9.1f}ms {after * 1000:>7.1f}ms {before / after:>7.1f}x '
+          f'{shared / max(total, 1):>10.0%}')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmarks the palette extraction.')
+  parser.add_argument('--folder', help='a folder of images to use instead of synthetic ones')
+  parser.add_argument('--limit', type=int, default=100, help='the most images used from the folder')
+  parser.add_argument('--sizes', default='640x480,1000x750', help='the sizes of the synthetic images')
+  parser.add_argument('--repeat', type=int, default=5, help='the times every image is run')
+  args = parser.parse_args()
+
+  if args.folder is not None:
+    workloads = folder_workload(args.folder, args.limit)
+  else:
+    workloads = synthetic_workloads(args.sizes.split(','))
+  bench(workloads, args.repeat)
@@ -0,0 +1,106 @@
+"""
+Measures classifier throughput under different thread budgets. Run from
+the tagger directory:
+  python -m benchmarks.thread_budget threads
+  python -m benchmarks.thread_budget workers [--pin]
+
+`threads` runs the models that share a worker side by side (like the
+broad pass does) with every intra-op thread count up to the number of
+cores. `workers` runs K workers, each on its own share of the cores as
+`TAGGER_WORKERS_PER_HOST=K` would. The weights are left uninitialized
+since they don't change how long inference takes.
+"""
+from typing import List, Tuple
+from timeit import default_timer as timer
+from multiprocessing import get_context
+from common.types import CustomThread
+from model import models
+import torchvision
+import argparse
+import threads
+import torch
+
+
+def counts(limit: int) -> List[int]:
+  """
+  Powers of two up to `limit`, always ending with `limit` itself.
+  """
+  values, n = [], 1
+  while n < limit:
+    values += [n]
+    n *= 2
+  return values + [limit]
+
+
+def run_model(name: str, batch: int, duration: float) -> Tuple[int, float]:
+  """
+  Runs batches through a model for `duration` seconds and returns
+  the number of images classified along with the elapsed time.
+  """
+  model = getattr(torchvision.models, name)(weights=None).eval()
+  tensor = torch.zeros(batch, 3, models.INPUT_SIZE, models.INPUT_SIZE)
+
+  with torch.no_grad():
+    model(tensor)
+    images = 0
+    start = timer()
+    while timer() - start < duration:
+      model(tensor)
+      images += batch
+  return images, timer() - start
+
+
+def run_parallel(name: str, parallel: int, batch: int, duration: float) -> Tuple[int, float]:
+  workers = [CustomThread(target=run_model, args=(name, batch, duration))
+             for _ in range(parallel)]
+  for worker in workers:
+    worker.start()
+  results = [worker.join() for worker in workers]
+  return sum([images for images, _ in results]), max([elapsed for _, elapsed in results])
+
+
+def bench_threads(name: str, batch: int, duration: float):
+  cores = threads.available_cores()
+  print(f'{len(cores)} cores, {threads.PARALLEL_MODELS} models in parallel\n')
+  print(f'{"intra-op":>8} {"img/s":>10}')
+
+  for n in counts(len(cores)):
+    threads.apply(threads.plan(cores, threads=n))
+    images, elapsed = run_parallel(name, threads.PARALLEL_MODELS, batch, duration)
+    rate = images / elapsed
+    print(f'{n:>8} {rate:>10.1f}')
+
+
+def run_worker(args: Tuple[int, int, str, int, float, bool]) -> Tuple[int, float]:
+  workers, index, name, batch, duration, pin = args
+  threads.apply(threads.plan(threads.available_cores(), workers, index), pin)
+  return run_parallel(name, threads.PARALLEL_MODELS, batch, duration)
+
+
+def bench_workers(name: str, batch: int, duration: float, pin: bool):
+  cores = threads.available_cores()
+  print(f'{len(cores)} cores, {"pinned" if pin else "unpinned"}\n')
+  print(f'{"workers":>8} {"intra-op":>8} {"img/s":>10}')
+
+  context = get_context('fork')
+  for k in counts(len(cores)):
+    with context.Pool(k) as pool:
+      results = pool.map(run_worker, [(k, i, name, batch, duration, pin) for i in range(k)])
+
+    rate = sum([images for images, _ in results]) / max([elapsed for _, elapsed in results])
+    print(f'{k:>8} {threads.plan(cores, k).intra_op:>8} {rate:>10.1f}')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmarks the tagger thread budgets.')
+  parser.add_argument('mode', choices=['threads', 'workers'])
+  parser.add_argument('--model', default='mobilenet_v2')
+  parser.add_argument('--batch', type=int, default=1)
+  parser.add_argument('--duration', type=float, default=5, help='seconds per measurement')
+  parser.add_argument('--pin', action='store_true', help='pin workers to their cores')
+  args = parser.parse_args()
+
+  if args.mode == 'threads':
+    bench_threads(args.model, args.batch, args.duration)
+  else:
+    bench_workers(args.model, args.batch, args.duration, args.pin)
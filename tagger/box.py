@@ -3,7 +3,7 @@ from typing import List, Tuple, Optional, cast, Any
 from enum import Enum
 import numpy as np
 
-BGRImage = np.ndarray
+ImageArray = np.ndarray
 
 
 class BoxType(Enum):
@@ -98,7 +98,7 @@ class Box:
 
   #
 
-  def crop(self, img: BGRImage) -> BGRImage:
+  def crop(self, img: ImageArray) -> ImageArray:
     img = np.asarray(cast(Any, img))
 
     x1, y1, x2, y2 = map(lambda p: max(int(p), 0), self.points)
@@ -202,3 +202,215 @@ class Box:
         return tl  # XYXY_TL
       else:
         return [tl[0], tl[1], w, h]  # XYWH_TL
+
+
+class BoxArray:
+  """
+  A number of boxes backed by a single [N, 4] array of their points, with
+  the same (bottom left origin) normalized layout as `Box.points`. Areas,
+  pairwise overlaps and suppression work on every box at once instead
+  of building a `Box` for each of them.
+  """
+  points: np.ndarray
+  box_type: BoxType
+
+  def __init__(self, points: Any, box_type=BoxType.XYXY_BL):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 4)
+    self.points = BoxArray.__normalize_points(points, box_type)
+    self.box_type = box_type
+
+  @staticmethod
+  def from_boxes(boxes: List[Box], box_type=BoxType.XYXY_BL) -> BoxArray:
+    arr = BoxArray(np.asarray([b.points for b in boxes], dtype=np.float64).reshape(-1, 4))
+    arr.box_type = box_type
+    return arr
+
+  def __len__(self) -> int:
+    return len(self.points)
+
+  def __getitem__(self, index: Any) -> Any:
+    """
+    Returns the `Box` at an integer index, or a `BoxArray`
+    of the boxes selected by a slice, mask or index array.
+    """
+    if isinstance(index, (int, np.integer)):
+      return Box(self.points[index].tolist()).convert(self.box_type)
+
+    arr = BoxArray(self.points[index])
+    arr.box_type = self.box_type
+    return arr
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def __str__(self):
+    return f'BoxArray({len(self)} boxes)'
+
+  def __repr__(self):
+    return self.__str__()
+
+  #
+
+  @property
+  def boxes(self) -> List[Box]:
+    return list(self)
+
+  @property
+  def box(self) -> np.ndarray:
+    return BoxArray.__convert_points(self.points, self.box_type)
+
+  @property
+  def x(self) -> np.ndarray:
+    return self.points[:, 0]
+
+  @property
+  def y(self) -> np.ndarray:
+    return self.points[:, 1]
+
+  @property
+  def xmax(self) -> np.ndarray:
+    return self.points[:, 2]
+
+  @property
+  def ymax(self) -> np.ndarray:
+    return self.points[:, 3]
+
+  @property
+  def width(self) -> np.ndarray:
+    return np.abs(self.xmax - self.x)
+
+  @property
+  def height(self) -> np.ndarray:
+    return np.abs(self.ymax - self.y)
+
+  @property
+  def area(self) -> np.ndarray:
+    return self.width * self.height
+
+  #
+
+  def intersects(self, other: BoxArray) -> np.ndarray:
+    """
+    Returns an [N, M] mask of which boxes of this array intersect which of `other`.
+    """
+    a, b = self.points[:, None], other.points[None]
+    return ((a[..., 2] > b[..., 0]) & (b[..., 2] > a[..., 0]) &
+            (a[..., 3] > b[..., 1]) & (b[..., 3] > a[..., 1]))
+
+  def contains(self, other: BoxArray) -> np.ndarray:
+    """
+    Returns an [N, M] mask of which boxes of this array contain which of `other`.
+    """
+    a, b = self.points[:, None], other.points[None]
+    return ((a[..., 0] <= b[..., 0]) & (a[..., 1] <= b[..., 1]) &
+            (a[..., 2] >= b[..., 2]) & (a[..., 3] >= b[..., 3]))
+
+  def intersection_area(self, other: BoxArray) -> np.ndarray:
+    a, b = self.points[:, None], other.points[None]
+    w = np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    h = np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+    return np.clip(w, 0, None) * np.clip(h, 0, None)
+
+  def iou(self, other: BoxArray) -> np.ndarray:
+    """
+    Returns the [N, M] intersection over union of every pair of boxes.
+    """
+    inter = self.intersection_area(other)
+    union = self.area[:, None] + other.area[None] - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+  def convert(self, to_type: BoxType) -> BoxArray:
+    return BoxArray(BoxArray.__convert_points(self.points, to_type), to_type)
+
+  def union(self, groups: np.ndarray) -> BoxArray:
+    """
+    Returns the smallest box around each group of boxes, where `groups`
+    holds the group index (0 to the number of groups) of every box.
+    """
+    groups = np.asarray(groups)
+    count = int(groups.max()) + 1 if len(groups) > 0 else 0
+    points = np.empty((count, 4))
+    points[:, :2], points[:, 2:] = np.inf, -np.inf
+    np.minimum.at(points[:, 0], groups, self.x)
+    np.minimum.at(points[:, 1], groups, self.y)
+    np.maximum.at(points[:, 2], groups, self.xmax)
+    np.maximum.at(points[:, 3], groups, self.ymax)
+
+    arr = BoxArray(points)
+    arr.box_type = self.box_type
+    return arr
+
+  def suppress(self, scores: Any, threshold: float = 0.45, classes: Any = None) -> np.ndarray:
+    """
+    Greedy non-max suppression that returns, for every box, the index of
+    the box it was suppressed by (its own index if it was kept). Boxes of
+    different `classes` never suppress each other.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    overlaps = self.iou(self) > threshold
+    if classes is not None:
+      classes = np.asarray(classes)
+      overlaps &= classes[:, None] == classes[None]
+
+    owner = np.full(len(self), -1)
+    for i in np.argsort(-scores, kind='stable'):
+      if owner[i] >= 0:
+        continue
+      claimed = overlaps[i] & (owner < 0)
+      owner[claimed] = i
+      owner[i] = i
+    return owner
+
+  def nms(self, scores: Any, threshold: float = 0.45, classes: Any = None) -> np.ndarray:
+    """
+    Returns the indices of the boxes kept by non-max suppression, highest score first.
+    """
+    owner = self.suppress(scores, threshold, classes)
+    kept = np.nonzero(owner == np.arange(len(self)))[0]
+    return kept[np.argsort(-np.asarray(scores)[kept], kind='stable')]
+
+  def merge(self, scores: Any, threshold: float = 0.45,
+            classes: Any = None) -> Tuple[np.ndarray, BoxArray, np.ndarray]:
+    """
+    Merges every box into the highest scoring box that overlaps it, like
+    `nms` but keeping the suppressed boxes. Returns the indices of the kept
+    boxes, the union of each kept box with the boxes merged into it and
+    the group (the position in the kept boxes) every box was merged into.
+    """
+    owner = self.suppress(scores, threshold, classes)
+    kept, groups = np.unique(owner, return_inverse=True)
+    groups = groups.ravel()
+    return kept, self.union(groups), groups
+
+  # internal methods
+
+  @staticmethod
+  def __normalize_points(points: np.ndarray, from_type: BoxType) -> np.ndarray:
+    x1, y1, x2, y2 = points.T
+    if from_type.is_bl():
+      if from_type.is_xyxy():
+        return points.copy()
+      else:
+        return np.stack([x1, y1, x1 + x2, y1 + y2], axis=1)
+    else:
+      if from_type.is_xyxy():
+        h = np.abs(y2 - y1)
+        return np.stack([x1, y1 - h, x2, y2 + h], axis=1)
+      else:
+        return np.stack([x1, y1 - y2, x1 + x2, y1], axis=1)
+
+  @staticmethod
+  def __convert_points(points: np.ndarray, to_type: BoxType) -> np.ndarray:
+    x1, y1, x2, y2 = points.T
+    w, h = np.abs(x2 - x1), np.abs(y2 - y1)
+    if to_type.is_bl():
+      if to_type.is_xyxy():
+        return points.copy()
+      else:
+        return np.stack([x1, y1, w, h], axis=1)
+    else:
+      if to_type.is_xyxy():
+        return np.stack([x1, y1 + h, x2, y2 - h], axis=1)
+      else:
+        return np.stack([x1, y1 + h, w, h], axis=1)
@@ -0,0 +1,185 @@
+from typing import Any, Optional
+from collections import OrderedDict
+from multiprocessing import Value
+from threading import Lock
+from common.types import ImageData
+from common import utils
+import hashlib
+import sqlite3
+import json
+import time
+import os
+
+
+class ResultCache(object):
+  """
+  Caches analysis results by a hash of the decoded image. Recently
+  used results are kept in memory in an LRU of at most `max_size`
+  entries and every result is also written to an sqlite database
+  at `path` (if given) so that the cache survives restarts.
+
+  The hit and miss counters live in shared memory so they count
+  lookups made by every process forked after the cache is created.
+  """
+  __version: str
+  __max_size: int
+  __max_disk_size: int
+  __path: Optional[str]
+  __entries: OrderedDict
+  __lock: Lock
+  __db: Optional[sqlite3.Connection]
+  __pid: int
+  __inserts: int
+
+  def __init__(self, version: str, max_size: int = 1024, path: str = None,
+               max_disk_size: int = 100000):
+    self.__version = version
+    self.__max_size = max_size
+    self.__max_disk_size = max_disk_size
+    self.__path = path
+    self.__entries = OrderedDict()
+    self.__lock = Lock()
+    self.__db = None
+    self.__pid = -1
+    self.__inserts = 0
+
+    self.__hits = Value('Q', 0)
+    self.__misses = Value('Q', 0)
+
+  #
+
+  @property
+  def enabled(self) -> bool:
+    return self.__max_size > 0 or self.__path is not None
+
+  @property
+  def hits(self) -> int:
+    return self.__hits.value
+
+  @property
+  def misses(self) -> int:
+    return self.__misses.value
+
+  def stats(self) -> dict:
+    total = self.hits + self.misses
+    with self.__lock:
+      memory_entries = len(self.__entries)
+      disk_entries = self.__count_rows()
+
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_rate': self.hits / total if total > 0 else 0.0,
+      'memory_entries': memory_entries,
+      'memory_capacity': self.__max_size,
+      'disk_entries': disk_entries,
+    }
+
+  #
+
+  def key(self, img: ImageData) -> str:
+    """
+    Returns the cache key for an image. The key covers the decoded
+    pixels and the cache version so results are invalidated when the
+    models or their configuration change.
+    """
+    h = hashlib.sha256(self.__version.encode())
+    h.update(str(img.data.shape).encode())
+    h.update(img.data.tobytes())
+    return h.hexdigest()
+
+  def get(self, key: str, record: bool = True) -> Optional[dict]:
+    """
+    Returns the cached result for `key` if there is one. The lookup
+    only counts towards the hit and miss counters if `record` is set.
+    """
+    if not self.enabled:
+      return None
+
+    with self.__lock:
+      value = self.__entries.get(key)
+      if value is not None:
+        self.__entries.move_to_end(key)
+      else:
+        value = self.__load(key)
+        if value is not None:
+          self.__remember(key, value)
+
+    if record:
+      self.__increment(self.__hits if value is not None else self.__misses)
+    return json.loads(value) if value is not None else None
+
+  def put(self, key: str, result: dict):
+    if not self.enabled:
+      return
+
+    value = utils.serialize(result)
+    with self.__lock:
+      self.__remember(key, value)
+      self.__store(key, value)
+
+  # private methods
+
+  @staticmethod
+  def __increment(counter: Any):
+    with counter.get_lock():
+      counter.value += 1
+
+  def __remember(self, key: str, value: str):
+    if self.__max_size <= 0:
+      return
+
+    self.__entries[key] = value
+    self.__entries.move_to_end(key)
+    while len(self.__entries) > self.__max_size:
+      self.__entries.popitem(last=False)
+
+  def __connect(self) -> Optional[sqlite3.Connection]:
+    # connections can't be shared with forked processes
+    # so each process opens its own.
+    if self.__path is None:
+      return None
+    if self.__pid == os.getpid():
+      return self.__db
+
+    os.makedirs(os.path.dirname(os.path.abspath(self.__path)), exist_ok=True)
+    db = sqlite3.connect(self.__path, timeout=30, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS results '
+               '(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)')
+    db.commit()
+
+    self.__db = db
+    self.__pid = os.getpid()
+    self.__inserts = 0
+    return db
+
+  def __load(self, key: str) -> Optional[str]:
+    db = self.__connect()
+    if db is None:
+      return None
+
+    row = db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+    return row[0] if row is not None else None
+
+  def __store(self, key: str, value: str):
+    db = self.__connect()
+    if db is None:
+      return
+
+    db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+               (key, value, time.time()))
+    # trim the oldest results every 1000 inserts made by this process.
+    # the rowids can't be used for this, replaced rows and inserts
+    # from other processes mean they skip values.
+    self.__inserts += 1
+    if self.__inserts % 1000 == 0:
+      db.execute('DELETE FROM results WHERE rowid NOT IN (SELECT rowid FROM results '
+                 'ORDER BY created DESC LIMIT ?)', (self.__max_disk_size,))
+    db.commit()
+
+  def __count_rows(self) -> int:
+    db = self.__connect()
+    if db is None:
+      return 0
+    return db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
@@ -1,13 +1,11 @@
 from __future__ import annotations
-from typing import Tuple, cast, Any, Union, Iterable, List
+from typing import Dict, Tuple, cast, Any, Optional, Union, Iterable, List
 from collections.abc import Iterable as IterableClass
-from math import sqrt, sin, cos, atan2, exp, pow, radians, degrees
-from colorthief import MMCQ
+from math import sqrt, pow, ceil
 
-from common import utils
 from common.types import ColorType
-from PIL import Image
 import numpy as np
+import os
 
 Range = Tuple[float, float]
 
@@ -31,6 +29,11 @@ XYZ_TO_SRGB = [
 CIE_D65 = [95.047, 100.0, 108.883]
 D = 0.206896552
 
+# the bits per channel colors are quantized to when extracting a palette
+PALETTE_SIGBITS = 5
+# the share of the palette split by population alone
+PALETTE_FRACT_BY_POPULATION = 0.75
+
 
 def convert_range(val: Union[float, Iterable[float]], src: Range, dest: Range) -> Any:
   def convert_range_iter() -> Iterable[float]:
@@ -59,6 +62,7 @@ class Color:
   _y: float
   _z: float
   _name: str
+  _lab: Optional[Tuple[float, float, float]]
 
   def __init__(self, x: float, y: float, z: float, name: str = None):
     assert 0 <= x <= 255
@@ -68,6 +72,7 @@ class Color:
     self._x = x
     self._y = y
     self._z = z
+    self._lab = None
     self._name = name or self.to_hex()
 
   def __repr__(self):
@@ -84,28 +89,12 @@ class Color:
     return '#' + ''.join(['%02X' % v for v in c])
 
   def to_lab(self) -> Tuple[float, float, float]:
-    def f(t: float) -> float:
-      if t > pow(D, 3):
-        return pow(t, 1 / 3)
-      return (t / (3 * pow(D, 2))) + (4 / 29)
-
-    x, y, z = tuple(convert_range(self.to_xyz(), (0, 1), (0, 100)))
-    xr, yr, zr = CIE_D65
-
-    l = 116 * f(y / yr) - 16
-    a = 500 * (f(x / xr) - f(y / yr))
-    b = 200 * (f(y / yr) - f(z / zr))
-    return l, a, b
+    if self._lab is None:
+      self._lab = tuple(xyz_to_lab(np.asarray(self.to_xyz())).tolist())
+    return cast(Any, self._lab)
 
   def to_lch(self) -> Tuple[float, float, float]:
-    l, a, b = self.to_lab()
-    c = sqrt((a ** 2) + (b ** 2))
-    h = atan2(b, a)
-    if h < 0:
-      h += radians(360)
-
-    h = degrees(h)
-    return l, c, h
+    return cast(Any, tuple(lab_to_lch(np.asarray(self.to_lab())).tolist()))
 
   def to_rgb(self) -> Tuple[int, int, int]:
     def linear_to_srgb(u: float) -> float:
@@ -135,37 +124,190 @@ def from_hex(s: str, name: str = None) -> Color:
 
 
 def from_rgb(r: int, g: int, b: int, name: str = None) -> Color:
-  def srgb_to_linear(u: float) -> float:
-    if u <= 0.04045:
-      return u / 12.92
-    return pow((u + 0.055) / 1.055, 2.4)
-
   c = (r, g, b)
   assert all([0 <= v <= 255 for v in c])
 
-  c = np.asarray([[srgb_to_linear(v / 255)] for v in c])
-  result = np.matmul(SRGB_to_XYZ, c).reshape(3)
+  result = rgb_to_xyz(np.asarray(c))
   return Color(*result, name=name)
 
 
+#
+# Vectorized Conversions
+#
+
+def srgb_to_linear(rgb: np.ndarray) -> np.ndarray:
+  """
+  Converts sRGB values in [0, 255] to linear RGB in [0, 1].
+  """
+  u = np.asarray(rgb, dtype=np.float64) / 255
+  return np.where(u <= 0.04045, u / 12.92, ((u + 0.055) / 1.055) ** 2.4)
+
+
+def rgb_to_xyz(rgb: np.ndarray) -> np.ndarray:
+  """
+  Converts an [..., 3] array of sRGB colors to CIE XYZ in [0, 1].
+  """
+  return srgb_to_linear(rgb) @ np.asarray(SRGB_to_XYZ).T
+
+
+def xyz_to_lab(xyz: np.ndarray) -> np.ndarray:
+  """
+  Converts an [..., 3] array of CIE XYZ colors in [0, 1] to CIE Lab.
+  """
+  t = np.asarray(xyz, dtype=np.float64) * 100 / np.asarray(CIE_D65)
+  f = np.where(t > D ** 3, np.cbrt(t), t / (3 * D ** 2) + 4 / 29)
+
+  fx, fy, fz = f[..., 0], f[..., 1], f[..., 2]
+  return np.stack([116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz)], axis=-1)
+
+
+def rgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+  """
+  Converts an [..., 3] array of sRGB colors in [0, 255] to CIE Lab.
+  """
+  return xyz_to_lab(rgb_to_xyz(rgb))
+
+
+def lab_to_lch(lab: np.ndarray) -> np.ndarray:
+  """
+  Converts an [..., 3] array of CIE Lab colors to LCh with the hue in degrees.
+  """
+  lab = np.asarray(lab, dtype=np.float64)
+  c = np.hypot(lab[..., 1], lab[..., 2])
+  h = np.degrees(np.arctan2(lab[..., 2], lab[..., 1])) % 360
+  return np.stack([lab[..., 0], c, h], axis=-1)
+
+
 #
 # Other Color Functions
 #
 
 def extract_palette(img: np.ndarray, num_colors: int = 5, quality: int = 10) -> List[Color]:
-  img = Image.fromarray(img).convert('RGBA')
-  w, h = img.size
-  pixels = img.getdata()
-  pixel_count = w * h
-  valid_pixels = []
-  for i in range(0, pixel_count, quality):
-    r, g, b, a = pixels[i]
-    if a >= 125:
-      if not (r > 250 and g > 250 and b > 250):
-        valid_pixels.append((r, g, b))
+  """
+  Extracts the dominant colors of an RGB(A) image, most common first.
+  Like the MMCQ algorithm of colorthief, every `quality`th pixel that
+  isn't transparent or near-white is counted in a histogram of colors
+  quantized to 5 bits per channel, which is split by median cuts until
+  there are `num_colors` boxes. Each box gives the average of its colors.
+  """
+  if img.ndim == 2:
+    img = np.stack([img] * 3, axis=-1)
+
+  pixels = img.reshape(-1, img.shape[-1])[::quality]
+  return palette_from_bins(palette_bins(pixels), num_colors)
+
+
+def palette_bins(pixels: np.ndarray) -> np.ndarray:
+  """
+  Returns the palette histogram bin of every pixel of an [..., 3] RGB(A)
+  array, or -1 for the transparent and near-white pixels that are left out.
+  Quantizing an image once lets palettes be extracted from any number of
+  regions of it by masking the bins.
+  """
+  valid = ~np.all(pixels[..., :3] > 250, axis=-1)
+  if pixels.shape[-1] == 4:
+    valid &= pixels[..., 3] >= 125
 
-  cmap = MMCQ.quantize(valid_pixels, num_colors)
-  return list(map(lambda t: from_rgb(*t), cmap.palette))
+  n = 1 << PALETTE_SIGBITS
+  rgb = pixels[..., :3].astype(np.int32) >> (8 - PALETTE_SIGBITS)
+  bins = (rgb[..., 0] * n + rgb[..., 1]) * n + rgb[..., 2]
+  return np.where(valid, bins, -1)
+
+
+def palette_from_bins(bins: np.ndarray, num_colors: int = 5) -> List[Color]:
+  """
+  Extracts the dominant colors of the pixels in `bins` (from `palette_bins`).
+  """
+  bins = bins[bins >= 0]
+  if len(bins) == 0:
+    return []
+
+  # the histogram only keeps the bins that are actually used
+  n = 1 << PALETTE_SIGBITS
+  counts = np.bincount(bins, minlength=n ** 3)
+  bins = np.nonzero(counts)[0]
+  weights = counts[bins]
+  coords = np.stack([bins // (n * n), (bins // n) % n, bins % n], axis=1)
+
+  boxes = median_cut(coords, weights, num_colors)
+  boxes.sort(key=lambda box: -weights[box].sum())
+
+  palette = []
+  for box in boxes:
+    w = weights[box]
+    centers = (coords[box] + 0.5) * (256 / n)
+    r, g, b = ((centers * w[:, None]).sum(0) / w.sum()).astype(int)
+    palette += [from_rgb(r, g, b)]
+  return palette
+
+
+def median_cut(coords: np.ndarray, weights: np.ndarray, num_boxes: int) -> List[np.ndarray]:
+  """
+  Splits the weighted histogram bins at `coords` into at most `num_boxes`
+  boxes the way MMCQ does, returning the bin indices in each box. The most
+  populated boxes are split first and then the ones with the largest
+  population times volume so that sparse regions of color aren't lost.
+  """
+  # a box is the bounds it covers and the indices of the bins inside it
+  Box = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+  def count(box: Box) -> int:
+    return int(weights[box[2]].sum())
+
+  def volume(box: Box) -> int:
+    return int(np.prod(box[1] - box[0] + 1))
+
+  def split(box: Box) -> Optional[Tuple[Box, Box]]:
+    lo, hi, indices = box
+    if count(box) <= 1:
+      return None
+
+    dim = int(np.argmax(hi - lo))
+    if hi[dim] == lo[dim]:
+      # the box is a single bin
+      return None
+
+    values = coords[indices, dim]
+    partial = np.cumsum(np.bincount(values - lo[dim], weights[indices], hi[dim] - lo[dim] + 1))
+    total = partial[-1]
+
+    # the cut is halfway between the median and the far side of the box
+    i = int(np.argmax(partial > total / 2))
+    left, right = i, hi[dim] - lo[dim] - i
+    if left <= right:
+      cut = min(hi[dim] - lo[dim] - 1, int(i + right / 2))
+    else:
+      cut = max(0, int(i - 1 - left / 2))
+    # without leaving either side empty
+    while partial[cut] == 0:
+      cut += 1
+    while partial[cut] == total and cut > 0 and partial[cut - 1] > 0:
+      cut -= 1
+    if partial[cut] == total:
+      return None
+
+    cut += lo[dim]
+    hi1, lo2 = hi.copy(), lo.copy()
+    hi1[dim], lo2[dim] = cut, cut + 1
+    below = values <= cut
+    return (lo, hi1, indices[below]), (lo2, hi, indices[~below])
+
+  boxes = [(coords.min(0), coords.max(0), np.arange(len(coords)))]
+  done = []
+  phases = [(ceil(PALETTE_FRACT_BY_POPULATION * num_boxes), count),
+            (num_boxes, lambda box: count(box) * volume(box))]
+
+  for target, priority in phases:
+    while len(boxes) > 0 and len(boxes) + len(done) < target:
+      boxes.sort(key=priority)
+      box = boxes.pop()
+      halves = split(box)
+      if halves is None:
+        # a single color can't be split any further
+        done += [box]
+      else:
+        boxes += list(halves)
+  return [indices for _, _, indices in boxes + done]
 
 
 def is_grayscale(color: Color) -> bool:
@@ -193,75 +335,63 @@ def CIE00(x: Color, y: Color) -> float:
   Calculates the human perceived difference between two colors.
   http://www2.ece.rochester.edu/~gsharma/ciede2000/ciede2000noteCRNA.pdf
   """
-  rad = lambda d: radians(d)
-  pow2 = lambda v: pow(v, 2)
+  return float(ciede2000(np.asarray([x.to_lab()]), np.asarray([y.to_lab()]))[0, 0])
 
-  Kl = 1
-  Kc = 1
-  Kh = 1
 
-  x1, y1, z1 = x.to_lab()
-  x2, y2, z2 = y.to_lab()
-
-  Lo = {1: x1, 2: x2}
-  ao = {1: y1, 2: y2}
-  bo = {1: z1, 2: z2}
+def ciede2000(lab1: np.ndarray, lab2: np.ndarray) -> np.ndarray:
+  """
+  Vectorized CIE 2000 color difference between every color in `lab1`
+  ([N, 3]) and every color in `lab2` ([M, 3]), returned as an [N, M]
+  array. Follows the formulation in the paper linked from `CIE00`.
+  """
+  L1, a1, b1 = [v[:, None] for v in np.asarray(lab1, dtype=np.float64).T]
+  L2, a2, b2 = [v[None, :] for v in np.asarray(lab2, dtype=np.float64).T]
 
   # 1. Calculate C'i and h'i
-  calc_C_ab = lambda i: sqrt(pow2(ao[i]) + pow2(bo[i]))
-  C1_ab = calc_C_ab(1)
-  C2_ab = calc_C_ab(2)
-
-  C_ab = (C1_ab + C2_ab) / 2
-  G = 0.5 * (1 - sqrt(pow(C_ab, 7) / (pow(C_ab, 7) + pow(25, 7))))
-
-  calc_a = lambda i: (1 + G) * ao[i]
-  a = {1: calc_a(1), 2: calc_a(2)}
+  C_ab = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2
+  G = 0.5 * (1 - np.sqrt(C_ab ** 7 / (C_ab ** 7 + 25 ** 7)))
 
-  calc_C = lambda i: sqrt(pow2(a[i]) + pow2(bo[i]))
-  C = {1: calc_C(1), 2: calc_C(2)}
-
-  # calc_h = lambda i: atan2(bo[i], a[i]) % rad(360)
-  calc_h = lambda i: degrees(atan2(bo[i], a[i])) if bo[i] > 0 else 360 + degrees(atan2(bo[i], a[i]))
-  h = {1: calc_h(1), 2: calc_h(2)}
+  a1p = (1 + G) * a1
+  a2p = (1 + G) * a2
+  C1p = np.hypot(a1p, b1)
+  C2p = np.hypot(a2p, b2)
+  h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+  h2p = np.degrees(np.arctan2(b2, a2p)) % 360
 
   # 2. Calculate ΔL', ΔC' and ΔH'
-  dL = Lo[2] - Lo[1]
-  dC = C[2] - C[1]
-  dh = h[2] - h[1]
-  if abs(dh) <= 180:
-    dh = abs(dh)
-  else:
-    dh = 360 - abs(dh)
+  dL = L2 - L1
+  dC = C2p - C1p
 
-  dH = 2 * sqrt(C[1] * C[2]) * sin(rad(dh) / 2)
+  chroma = C1p * C2p
+  dh = h2p - h1p
+  dh = np.where(dh > 180, dh - 360, np.where(dh < -180, dh + 360, dh))
+  dh = np.where(chroma == 0, 0, dh)
+  dH = 2 * np.sqrt(chroma) * np.sin(np.radians(dh) / 2)
 
   # 3. Calculate CIEDE2000 Color Difference ΔE
-  L_avg = (Lo[1] + Lo[2]) / 2
-  C_avg = (C[1] + C[2]) / 2
+  L_avg = (L1 + L2) / 2
+  C_avg = (C1p + C2p) / 2
 
-  if abs(h[1] - h[2]) <= 180:
-    h_avg = (h[1] + h[2]) / 2
-  else:
-    h_avg = (h[1] + h[2] - 360) / 2
+  h_sum = h1p + h2p
+  h_avg = np.where(np.abs(h1p - h2p) <= 180, h_sum / 2,
+                   np.where(h_sum < 360, (h_sum + 360) / 2, (h_sum - 360) / 2))
+  h_avg = np.where(chroma == 0, h_sum, h_avg)
 
-  T = 1 - 0.17 * cos(rad(h_avg - 30)) + 0.24 * cos(rad(2 * h_avg)) \
-      + 0.32 * cos(rad(3 * h_avg + 6)) - 0.2 * cos(rad(4 * h_avg - 63))
+  T = 1 - 0.17 * np.cos(np.radians(h_avg - 30)) + 0.24 * np.cos(np.radians(2 * h_avg)) \
+      + 0.32 * np.cos(np.radians(3 * h_avg + 6)) - 0.2 * np.cos(np.radians(4 * h_avg - 63))
 
-  theta = 30 * exp(-pow2((h_avg - 275) / 25))
+  theta = 30 * np.exp(-((h_avg - 275) / 25) ** 2)
 
-  Rc = 2 * sqrt(pow(C_avg, 7) / (pow(C_avg, 7) + pow(25, 7)))
-  Sl = 1 + ((0.015 * pow2(L_avg - 50)) / (sqrt(20 + pow2(L_avg - 50))))
+  Rc = 2 * np.sqrt(C_avg ** 7 / (C_avg ** 7 + 25 ** 7))
+  Sl = 1 + (0.015 * (L_avg - 50) ** 2) / np.sqrt(20 + (L_avg - 50) ** 2)
   Sc = 1 + 0.045 * C_avg
   Sh = 1 + 0.015 * C_avg * T
-  Rt = -sin(rad(2 * theta)) * Rc
-
-  dLf = dL / (Kl * Sl)
-  dCf = dC / (Kc * Sc)
-  dHf = dH / (Kh * Sh)
+  Rt = -np.sin(np.radians(2 * theta)) * Rc
 
-  E = sqrt(pow2(dLf) + pow2(dCf) + pow2(dHf) + (Rt * dCf * dHf))
-  return E
+  dLf = dL / Sl
+  dCf = dC / Sc
+  dHf = dH / Sh
+  return np.sqrt(dLf ** 2 + dCf ** 2 + dHf ** 2 + Rt * dCf * dHf)
 
 
 #
@@ -297,10 +427,137 @@ class Colors(object):
 
   @staticmethod
   def as_list() -> List[Color]:
-    return [c for c in Colors.__dict__.values() if isinstance(c, Color)]
+    return PALETTE
 
   @staticmethod
   def find_closest(color: Color) -> Color:
-    deltas = [(CIE00(c, color), c) for c in Colors.as_list()]
-    deltas.sort(key=lambda t: t[0])
-    return deltas[0][1]
+    return Colors.find_closest_many([color])[0]
+
+  @staticmethod
+  def find_closest_many(colors: List[Color]) -> List[Color]:
+    lab = np.asarray([c.to_lab() for c in colors]).reshape(-1, 3)
+    return [PALETTE[i] for i in Colors.closest_indices(lab)]
+
+  @staticmethod
+  def closest_indices(lab: np.ndarray) -> np.ndarray:
+    """
+    Returns the index in `PALETTE` of the closest palette
+    color to each color of an [N, 3] array of Lab colors.
+    """
+    return np.argmin(ciede2000(lab, PALETTE_LAB), axis=1)
+
+
+# the palette colors and their Lab values, computed once
+PALETTE = [c for c in Colors.__dict__.values() if isinstance(c, Color)]
+PALETTE_LAB = np.asarray([c.to_lab() for c in PALETTE])
+
+# the color types the palette has colors of, in the order of a color
+# histogram. gray isn't one while its palette color is left out.
+COLOR_TYPES = [v for k, v in vars(ColorType).items()
+               if not k.startswith('_') and v in {str(c) for c in PALETTE}]
+# the index into COLOR_TYPES of each palette color
+PALETTE_TYPES = np.asarray([COLOR_TYPES.index(str(c)) for c in PALETTE])
+
+
+#
+# Palette Lookup Table
+#
+
+class ColorLUT(object):
+  """
+  A lookup table from quantized sRGB to the index of the closest palette
+  color. Each channel is quantized to `bits` bits (2^bits bins) and every
+  bin maps to the palette color closest to its center, so finding the
+  palette color of any pixel is a single array index.
+  """
+  bits: int
+  table: np.ndarray
+
+  def __init__(self, table: np.ndarray, bits: int):
+    assert table.shape == (1 << bits,) * 3
+    self.bits = bits
+    self.table = table
+
+  @staticmethod
+  def build(bits: int = 6, chunk_size: int = 16384) -> ColorLUT:
+    n = 1 << bits
+    step = 256 / n
+    centers = np.arange(n) * step + (step - 1) / 2
+    r, g, b = np.meshgrid(centers, centers, centers, indexing='ij')
+    lab = rgb_to_lab(np.stack([r, g, b], axis=-1).reshape(-1, 3))
+
+    # chunked to bound the size of the [chunk, palette] difference matrix
+    indices = [Colors.closest_indices(lab[i:i + chunk_size]) for i in range(0, len(lab), chunk_size)]
+    table = np.concatenate(indices).astype(np.uint8).reshape(n, n, n)
+    return ColorLUT(table, bits)
+
+  @staticmethod
+  def load(path: Optional[str] = None, bits: int = 6) -> ColorLUT:
+    """
+    Loads the table saved at `path`, or builds it (and saves it to
+    `path`) if it's missing or was built for a different palette.
+    """
+    key = palette_key()
+    if path is not None and os.path.exists(path):
+      with np.load(path) as data:
+        if str(data['key']) == key and int(data['bits']) == bits:
+          return ColorLUT(data['table'], bits)
+
+    lut = ColorLUT.build(bits)
+    if path is not None:
+      os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+      # written to a temporary file first so other processes
+      # never load a partially written table.
+      tmp = f'{path}.{os.getpid()}.tmp'
+      with open(tmp, 'wb') as f:
+        np.savez(f, table=lut.table, bits=bits, key=key)
+      os.replace(tmp, path)
+    return lut
+
+  #
+
+  def lookup(self, rgb: np.ndarray) -> np.ndarray:
+    """
+    Returns the palette index of every color of an [..., 3] uint8 sRGB array.
+    """
+    q = np.asarray(rgb, dtype=np.uint8) >> (8 - self.bits)
+    return self.table[q[..., 0], q[..., 1], q[..., 2]]
+
+  def find_closest(self, colors: List[Color]) -> List[Color]:
+    rgb = np.asarray([c.to_rgb() for c in colors], dtype=np.uint8).reshape(-1, 3)
+    return [PALETTE[i] for i in self.lookup(rgb)]
+
+  def coverage(self, img: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
+    """
+    Returns the fraction of the pixels of an RGB image (or of the pixels
+    selected by `mask`) closest to each palette color.
+    """
+    indices = self.lookup(img[..., :3])
+    if mask is not None:
+      indices = indices[mask]
+
+    counts = np.bincount(indices.ravel(), minlength=len(PALETTE))
+    return counts / max(1, indices.size)
+
+  def histogram(self, img: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
+    """
+    Like `coverage`, but with the palette colors of each color type (e.g.
+    the reds) added together. The fractions are in the order of `COLOR_TYPES`
+    so the histogram of every image has the same length.
+    """
+    types = PALETTE_TYPES[self.lookup(img[..., :3])]
+    if mask is not None:
+      types = types[mask]
+
+    counts = np.bincount(types.ravel(), minlength=len(COLOR_TYPES))
+    return counts / max(1, types.size)
+
+  def coverage_by_type(self, img: np.ndarray, mask: np.ndarray = None) -> Dict[str, float]:
+    return dict(zip(COLOR_TYPES, self.histogram(img, mask).tolist()))
+
+
+def palette_key() -> str:
+  """
+  Identifies the palette so saved lookup tables are rebuilt when it changes.
+  """
+  return ','.join([f'{c}:{c.to_hex()}' for c in PALETTE])
@@ -1,11 +1,15 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
-from typing import Any, Union
+from typing import Any, Optional, Tuple, Union
 from dataclasses import dataclass
 from enum import Enum
 from threading import Thread
+from PIL import Image as PILImage
 import numpy as np
+import mimetypes
 import cv2
+import io
+import os
 
 
 class Serializable(ABC):
@@ -76,22 +80,94 @@ class Orientation(Enum):
 
 #
 
+# the imdecode flags that decode a color image at 1 / n scale
+REDUCED_FLAGS = {
+  1: cv2.IMREAD_COLOR,
+  2: cv2.IMREAD_REDUCED_COLOR_2,
+  4: cv2.IMREAD_REDUCED_COLOR_4,
+  8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+class DecodeError(ValueError):
+  """
+  Raised when an image can't be read or decoded.
+  """
+  pass
+
+
 class ImageData:
+  """
+  An uploaded image decoded once into a contiguous RGB array. Images
+  much larger than `min_size` are decoded at 1/2, 1/4 or 1/8 scale
+  (jpegs are scaled while decoding), keeping the longest side at least
+  `min_size` pixels. `width` and `height` are always those of the file.
+  """
   file_name: str
   content_type: str
   data: np.ndarray
+  width: int
+  height: int
 
-  def __init__(self, file: dict):
+  def __init__(self, file: dict, min_size: int = 0):
     self.file_name = file['filename']
     self.content_type = file['content_type']
 
-    nparr = np.frombuffer(file['body'], np.uint8)
-    self.data = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
+    body = file['body']
+    size = ImageData.__read_size(body)
+    factor = ImageData.__reduction(size, min_size)
+
+    nparr = np.frombuffer(body, np.uint8)
+    data = cv2.imdecode(nparr, REDUCED_FLAGS[factor] | cv2.IMREAD_IGNORE_ORIENTATION)
+    if data is not None:
+      self.data = cv2.cvtColor(data, cv2.COLOR_BGR2RGB, dst=data)
+    else:
+      # opencv can't decode gifs
+      self.data = np.asarray(PILImage.open(io.BytesIO(body)).convert('RGB'))
+
+    h, w = self.data.shape[:2]
+    self.width, self.height = size if size is not None else (w, h)
+
+  @staticmethod
+  def from_path(path: str, min_size: int = 0) -> ImageData:
+    with open(path, 'rb') as f:
+      body = f.read()
+
+    content_type = mimetypes.guess_type(path)[0]
+    return ImageData({'filename': os.path.basename(path),
+                      'content_type': content_type,
+                      'body': body}, min_size)
 
   @property
   def shape(self):
     return self.data.shape
 
+  @property
+  def scale(self) -> float:
+    """
+    The size of the decoded image relative to the original.
+    """
+    return self.data.shape[1] / self.width
+
+  # private methods
+
+  @staticmethod
+  def __read_size(body: bytes) -> Optional[Tuple[int, int]]:
+    # only the header is read, the pixels aren't decoded
+    try:
+      return PILImage.open(io.BytesIO(body)).size
+    except OSError:
+      return None
+
+  @staticmethod
+  def __reduction(size: Optional[Tuple[int, int]], min_size: int) -> int:
+    if size is None or min_size <= 0:
+      return 1
+    for factor in [8, 4, 2]:
+      if max(size) // factor >= min_size:
+        return factor
+    return 1
+
 
 @dataclass
 class Tag:
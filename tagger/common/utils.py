@@ -17,7 +17,11 @@ def add_to_key(d: dict, key: Any, value: Any):
     d[key] = value
 
 
-def intersection(a: Sequence, b: Sequence) -> Generator:
+def intersection(a: Iterable, b: Iterable) -> Generator:
+  """
+  Yields the items of `a` that are also in `b`, in order.
+  """
+  b = set(b)
   for n in a:
     if n in b:
       yield n
@@ -62,24 +66,28 @@ def scale(img: np.ndarray, value: float) -> np.ndarray:
 
 
 def union(a: Sequence, b: Sequence) -> Generator:
-  def duplicate(s: Sequence, index: int):
-    a_index = index + 1 if s is b else index
-    return (
-      s[index] in a[:min(a_index, len(a))] or
-      s[index] in b[:min(index, len(b))]
-    )
-
+  """
+  Yields the items of `a` and `b` alternately, skipping
+  any item that was already yielded. Items must be hashable.
+  """
+  seen = set()
   for i in range(max(len(a), len(b))):
-    if i < len(a) and not duplicate(a, i):
-      yield a[i]
-    if i < len(b) and not duplicate(b, i):
-      yield b[i]
-
-
-def unique(s: Sequence) -> Generator:
-  for i in range(len(s)):
-    if s[i] not in s[:i]:
-      yield s[i]
+    for s in (a, b):
+      if i < len(s) and s[i] not in seen:
+        seen.add(s[i])
+        yield s[i]
+
+
+def unique(s: Iterable) -> Generator:
+  """
+  Yields the items of `s` in order, skipping any
+  that were seen before. Items must be hashable.
+  """
+  seen = set()
+  for item in s:
+    if item not in seen:
+      seen.add(item)
+      yield item
 
 
 def unpack(itr: Iterable) -> Generator:
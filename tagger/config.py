@@ -0,0 +1,124 @@
+"""
+Tagger configuration
+
+Every value can be overridden by setting an environment
+variable of the same name prefixed with `TAGGER_`.
+"""
+import os
+
+
+def env_str(name: str, default: str) -> str:
+  return os.environ.get(f'TAGGER_{name}', default)
+
+
+def env_int(name: str, default: int) -> int:
+  return int(env_str(name, str(default)))
+
+
+def env_dict(name: str, default: str = '') -> dict:
+  """
+  Parses a variable of the form `key1=value1,key2=value2`.
+  """
+  pairs = [p.split('=', 1) for p in env_str(name, default).split(',') if p.strip()]
+  return {k.strip(): v.strip() for k, v in pairs}
+
+
+PORT = env_int('PORT', 8888)
+# the level of the messages that are logged ('debug', 'info', 'warning' or 'error')
+LOG_LEVEL = env_str('LOG_LEVEL', 'info')
+# the number of server processes forked after the models are loaded,
+# which all accept on the same port (0 forks one per core)
+SERVER_PROCESSES = env_int('SERVER_PROCESSES', 1)
+
+# the kind of pool used to run inference ('thread' or 'process')
+EXECUTOR = env_str('EXECUTOR', 'thread')
+# the number of images that are analyzed concurrently
+EXECUTOR_WORKERS = env_int('EXECUTOR_WORKERS', 2)
+# the number of requests allowed to wait for a free worker
+# before new requests are turned away with a 503
+EXECUTOR_QUEUE_SIZE = env_int('EXECUTOR_QUEUE_SIZE', 16)
+# the value of the Retry-After header sent with a 503
+RETRY_AFTER = env_int('RETRY_AFTER', 5)
+
+# the largest number of inputs run through a model at once
+BATCH_MAX_SIZE = env_int('BATCH_MAX_SIZE', 8)
+# how long (in milliseconds) a batch waits to fill up before it runs
+BATCH_MAX_DELAY = env_int('BATCH_MAX_DELAY', 10)
+
+# images are decoded at 1/2, 1/4 or 1/8 scale as long as their longest
+# side stays at least this many pixels (0 always decodes at full scale)
+DECODE_MIN_SIZE = env_int('DECODE_MIN_SIZE', 1280)
+
+# the most yolo boxes per image that are classified by the second stage
+MAX_CROPS = env_int('MAX_CROPS', 16)
+# boxes smaller than this percentage of the image aren't classified
+CROP_MIN_AREA = env_int('CROP_MIN_AREA', 1)
+# boxes of the same class that overlap by more than this percentage
+# (intersection over union) share one crop (0 disables it)
+CROP_MERGE_IOU = env_int('CROP_MERGE_IOU', 70)
+# when there are at least this many boxes of a class (like a crowd of
+# people) they all share the crop of the best one (0 disables it)
+CROP_GROUP_SIZE = env_int('CROP_GROUP_SIZE', 0)
+
+# the most images accepted by a single request to /batch
+BATCH_MAX_FILES = env_int('BATCH_MAX_FILES', 64)
+# the directory images sent to /batch and /duplicates as paths must be
+# in. paths are rejected altogether when it isn't set.
+IMAGE_DIR = env_str('IMAGE_DIR', '')
+# the largest request body accepted (in bytes), larger ones get a 413
+MAX_BODY_SIZE = env_int('MAX_BODY_SIZE', 100 * 1024 * 1024)
+
+# bump to invalidate cached results after the models change
+MODEL_VERSION = env_str('MODEL_VERSION', '1')
+# the number of results kept in memory (0 disables the memory cache)
+CACHE_SIZE = env_int('CACHE_SIZE', 1024)
+# the sqlite database results are persisted to (empty disables it)
+CACHE_PATH = env_str('CACHE_PATH', os.path.join(os.path.dirname(__file__), 'cache', 'results.sqlite3'))
+# the number of results (and image hashes) kept in the database
+CACHE_DISK_SIZE = env_int('CACHE_DISK_SIZE', 100000)
+
+# whether images are tagged with their dominant colors (0 or 1)
+COLOR_TAGS = env_int('COLOR_TAGS', 1) == 1
+# the number of detected subjects given their own palette, separate
+# from the palette of the background around them (0 disables it)
+REGION_COLORS = env_int('REGION_COLORS', 0)
+# the bits per channel of the lookup table from rgb to palette colors
+COLOR_LUT_BITS = env_int('COLOR_LUT_BITS', 6)
+# where the lookup table is saved once it's built (empty disables it)
+COLOR_LUT_PATH = env_str('COLOR_LUT_PATH', os.path.join(os.path.dirname(__file__), 'cache', 'color_lut.npz'))
+
+# the largest hamming distance between the perceptual hashes of two
+# images for one to reuse the tags of the other. it's off by default
+# (0), images with the same layout but another subject can be that close.
+DUPLICATE_DISTANCE = env_int('DUPLICATE_DISTANCE', 0)
+# the default hamming distance used when searching for duplicates
+DUPLICATE_SEARCH_DISTANCE = env_int('DUPLICATE_SEARCH_DISTANCE', 10)
+
+# the directory model weights are loaded from (and downloaded to)
+MODEL_DIR = env_str('MODEL_DIR', os.path.join(os.path.dirname(__file__), 'weights'))
+# when models are loaded ('lazy' on first use or 'eager' at startup)
+MODEL_LOADING = env_str('MODEL_LOADING', 'eager')
+# the format models are loaded in ('eager', 'torchscript' or 'onnx')
+MODEL_FORMAT = env_str('MODEL_FORMAT', 'eager')
+# the imagenet models that run quantized to int8 and how they were
+# quantized ('static' or 'dynamic'), e.g. `mobilenet=static,shufflenet=dynamic`
+QUANTIZE = env_dict('QUANTIZE')
+
+# the threads used by onnx runtime within and across ops (0 picks automatically)
+ORT_INTRA_OP_THREADS = env_int('ORT_INTRA_OP_THREADS', 0)
+ORT_INTER_OP_THREADS = env_int('ORT_INTER_OP_THREADS', 1)
+
+# the number of tagger workers sharing this host and the index of this
+# one, each worker runs on its own equal share of the host's cores
+WORKERS_PER_HOST = env_int('WORKERS_PER_HOST', 1)
+WORKER_INDEX = env_int('WORKER_INDEX', 0)
+# the threads torch uses within an op (0 splits the worker's cores
+# between the models that run at the same time)
+TORCH_THREADS = env_int('TORCH_THREADS', 0)
+# the threads torch uses to run independent ops in parallel
+TORCH_INTEROP_THREADS = env_int('TORCH_INTEROP_THREADS', 1)
+# the most models that run at the same time in a worker. each of
+# yolo, mobilenet and shufflenet has its own batch scheduler thread.
+PARALLEL_MODELS = env_int('PARALLEL_MODELS', 3)
+# whether workers are pinned to their share of cores (0 or 1)
+PIN_CORES = env_int('PIN_CORES', 0) == 1
@@ -0,0 +1,2 @@
+# the tests import the tagger modules the same way main.py does, from
+# the tagger directory, which pytest adds to the path for this file.
@@ -0,0 +1,281 @@
+from __future__ import annotations
+from typing import Any, Dict, List, Optional, Tuple
+from dataclasses import dataclass
+from collections import OrderedDict
+from multiprocessing import Value
+from threading import Lock
+import numpy as np
+import sqlite3
+import cv2
+import os
+
+
+#
+# Perceptual Hashing
+#
+
+# bumped whenever `dhash` changes so hashes stored by an older
+# version aren't compared with new ones. 2 hashes rgb images.
+HASH_VERSION = 2
+
+
+def dhash(img: np.ndarray, size: int = 8) -> int:
+  """
+  Computes the difference hash of an image. The image is shrunk to
+  a (size + 1) x size grayscale thumbnail and each bit of the hash
+  records whether a pixel is brighter than its right neighbour, so
+  the hash barely changes when an image is resized or recompressed.
+  """
+  if img.ndim == 3 and img.shape[2] == 4:
+    img = cv2.cvtColor(img, cv2.COLOR_RGBA2GRAY)
+  elif img.ndim == 3:
+    img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+  small = cv2.resize(img, (size + 1, size), interpolation=cv2.INTER_AREA)
+  bits = small[:, 1:] > small[:, :-1]
+  return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming(a: int, b: int) -> int:
+  return bin(a ^ b).count('1')
+
+
+#
+# BK-Tree
+#
+
+class BKNode:
+  __slots__ = ('value', 'items', 'children')
+
+  def __init__(self, value: int, item: Any):
+    self.value = value
+    self.items = [item]
+    self.children: Dict[int, BKNode] = {}
+
+
+class BKTree(object):
+  """
+  A BK-tree over hamming distance. Searching for every value within
+  a small radius only visits the subtrees whose distance from a node
+  could still be in range, instead of comparing against every hash.
+  """
+  __root: Optional[BKNode]
+  __size: int
+
+  def __init__(self):
+    self.__root = None
+    self.__size = 0
+
+  def __len__(self) -> int:
+    return self.__size
+
+  def add(self, value: int, item: Any):
+    self.__size += 1
+    if self.__root is None:
+      self.__root = BKNode(value, item)
+      return
+
+    node = self.__root
+    while True:
+      d = hamming(value, node.value)
+      if d == 0:
+        node.items += [item]
+        return
+
+      child = node.children.get(d)
+      if child is None:
+        node.children[d] = BKNode(value, item)
+        return
+      node = child
+
+  def search(self, value: int, radius: int) -> List[Tuple[int, Any]]:
+    """
+    Returns all items within `radius` of `value` as a list of
+    (distance, item) tuples sorted by distance.
+    """
+    if self.__root is None:
+      return []
+
+    results = []
+    stack = [self.__root]
+    while len(stack) > 0:
+      node = stack.pop()
+      d = hamming(value, node.value)
+      if d <= radius:
+        results += [(d, item) for item in node.items]
+
+      for dist, child in node.children.items():
+        if d - radius <= dist <= d + radius:
+          stack += [child]
+
+    results.sort(key=lambda t: t[0])
+    return results
+
+
+#
+# Duplicate Index
+#
+
+@dataclass
+class Duplicate:
+  """
+  An image that was previously analyzed.
+  """
+  # the result cache key of the image
+  key: str
+  # the name of the image file
+  name: str
+
+
+class DuplicateIndex(object):
+  """
+  An index of the perceptual hashes of recently analyzed images. Hashes
+  are persisted to an sqlite database at `path` (if given), and any
+  rows added by other processes are picked up before each search.
+  Only rows stored with the current `HASH_VERSION` are loaded.
+
+  Like the result cache the index keeps at most about `max_size` hashes,
+  both in the database and in the tree of each process, and hashes of
+  results that were evicted from the cache are removed when found.
+  """
+  __path: Optional[str]
+  __max_size: int
+  __tree: BKTree
+  __entries: OrderedDict
+  __last_row: int
+  __inserts: int
+  __lock: Lock
+  __db: Optional[sqlite3.Connection]
+  __pid: int
+
+  def __init__(self, path: str = None, max_size: int = 100000):
+    self.__path = path
+    self.__max_size = max_size
+    self.__tree = BKTree()
+    self.__entries = OrderedDict()
+    self.__last_row = 0
+    self.__inserts = 0
+    self.__lock = Lock()
+    self.__db = None
+    self.__pid = -1
+
+    self.__reused = Value('Q', 0)
+
+  #
+
+  @property
+  def reused(self) -> int:
+    """
+    The number of results that were reused from a near-duplicate.
+    """
+    return self.__reused.value
+
+  def stats(self) -> dict:
+    # the hashes this process has loaded so far, syncing with the
+    # database here would block the IOLoop
+    with self.__lock:
+      return {'hashes': len(self.__entries), 'reused': self.reused}
+
+  #
+
+  def add(self, value: int, key: str, name: str):
+    with self.__lock:
+      self.__sync()
+      if (key, name) in self.__entries:
+        return
+
+      db = self.__connect()
+      if db is not None:
+        # replaces the row of an older hash version
+        db.execute('INSERT OR REPLACE INTO hashes (hash, key, name, version) VALUES (?, ?, ?, ?)',
+                   (format(value, '016x'), key, name, HASH_VERSION))
+        # trim the oldest hashes every 1000 inserts made by this process
+        self.__inserts += 1
+        if self.__inserts % 1000 == 0:
+          db.execute('DELETE FROM hashes WHERE rowid NOT IN (SELECT rowid FROM hashes '
+                     'ORDER BY rowid DESC LIMIT ?)', (self.__max_size,))
+        db.commit()
+        # picked up by the next sync along with the rows of other processes
+        self.__sync()
+      else:
+        self.__insert(value, key, name)
+
+  def remove(self, key: str):
+    """
+    Removes the hashes of a result cache key, once its result is gone.
+    """
+    with self.__lock:
+      for entry in [e for e in self.__entries if e[0] == key]:
+        del self.__entries[entry]
+
+      db = self.__connect()
+      if db is not None:
+        db.execute('DELETE FROM hashes WHERE key = ?', (key,))
+        db.commit()
+
+  def search(self, value: int, radius: int) -> List[Tuple[int, Duplicate]]:
+    with self.__lock:
+      self.__sync()
+      # the tree still holds the hashes that were removed since it was built
+      return [(d, dup) for d, dup in self.__tree.search(value, radius)
+              if (dup.key, dup.name) in self.__entries]
+
+  def record_reuse(self):
+    with self.__reused.get_lock():
+      self.__reused.value += 1
+
+  # private methods
+
+  def __insert(self, value: int, key: str, name: str):
+    self.__entries[(key, name)] = value
+    self.__entries.move_to_end((key, name))
+    self.__tree.add(value, Duplicate(key, name))
+
+    # hashes can't be taken out of a bk-tree, so once it holds twice
+    # as many as it should it's rebuilt from the newest ones
+    if len(self.__tree) > 2 * self.__max_size:
+      while len(self.__entries) > self.__max_size:
+        self.__entries.popitem(last=False)
+      self.__tree = BKTree()
+      for (key, name), value in self.__entries.items():
+        self.__tree.add(value, Duplicate(key, name))
+
+  def __connect(self) -> Optional[sqlite3.Connection]:
+    # connections can't be shared with forked processes so
+    # each process opens its own and rebuilds the tree from it.
+    if self.__path is None:
+      return None
+    if self.__pid == os.getpid():
+      return self.__db
+
+    os.makedirs(os.path.dirname(os.path.abspath(self.__path)), exist_ok=True)
+    db = sqlite3.connect(self.__path, timeout=30, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS hashes (hash TEXT NOT NULL, '
+               'key TEXT NOT NULL, name TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 1, '
+               'UNIQUE (key, name))')
+    columns = [row[1] for row in db.execute('PRAGMA table_info(hashes)')]
+    if 'version' not in columns:
+      # tables from before hashes were versioned hold version 1 hashes
+      db.execute('ALTER TABLE hashes ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+    db.commit()
+
+    self.__db = db
+    self.__pid = os.getpid()
+    self.__tree = BKTree()
+    self.__entries = OrderedDict()
+    self.__last_row = 0
+    self.__inserts = 0
+    return db
+
+  def __sync(self):
+    db = self.__connect()
+    if db is None:
+      return
+
+    rows = db.execute('SELECT rowid, hash, key, name, version FROM hashes WHERE rowid > ? '
+                      'ORDER BY rowid', (self.__last_row,)).fetchall()
+    for row, value, key, name, version in rows:
+      if version == HASH_VERSION:
+        self.__insert(int(value, 16), key, name)
+      self.__last_row = row
@@ -0,0 +1,104 @@
+from typing import Any, Callable, Optional
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Lock
+import metrics
+
+pending_gauge = metrics.Gauge('tagger_executor_pending', 'Requests running or queued for inference')
+rejected_counter = metrics.Counter('tagger_executor_rejected_total', 'Requests turned away because the queue was full')
+
+
+class QueueFullError(Exception):
+  """
+  Raised when a task is submitted to an executor whose
+  admission queue is already full.
+  """
+  pass
+
+
+class InferenceExecutor(object):
+  """
+  A bounded executor that runs inference off of the IOLoop.
+  At most `workers` tasks run at once and at most `queue_size`
+  more are allowed to wait for a free worker. Any tasks submitted
+  past that are rejected instead of piling up behind slow ones.
+  """
+  __pool: Executor
+  __limit: int
+  __pending: int
+  __lock: Lock
+
+  def __init__(self, kind: str = 'thread', workers: int = 2, queue_size: int = 16,
+               initializer: Optional[Callable[[], Any]] = None):
+    assert workers > 0 and queue_size >= 0
+
+    # the initializer only runs in process pools, where it's
+    # called once at the start of each worker process.
+    if kind == 'thread':
+      self.__pool = ThreadPoolExecutor(workers, thread_name_prefix='inference')
+    elif kind == 'process':
+      self.__pool = ProcessPoolExecutor(workers, initializer=initializer)
+    else:
+      raise ValueError(f'unknown executor kind: {kind}')
+
+    self.__limit = workers + queue_size
+    self.__pending = 0
+    self.__lock = Lock()
+
+  #
+
+  @property
+  def pending(self) -> int:
+    """
+    The number of tasks that are either running or queued.
+    """
+    return self.__pending
+
+  @property
+  def capacity(self) -> int:
+    return self.__limit
+
+  #
+
+  def reserve(self) -> bool:
+    """
+    Takes a slot for a task that's submitted later, like one for a
+    request whose body is still streaming in. Returns whether there was
+    room. A reserved slot is either used by `submit(..., reserved=True)`
+    or given back with `release`.
+    """
+    with self.__lock:
+      if self.__pending >= self.__limit:
+        rejected_counter.inc()
+        return False
+      self.__pending += 1
+      pending_gauge.inc()
+      return True
+
+  def submit(self, fn: Callable, *args: Any, reserved: bool = False) -> Future:
+    """
+    Schedules `fn(*args)` to run on the pool, in a slot taken with
+    `reserve` if `reserved` is set. Raises a `QueueFullError` if
+    there is no room left.
+    """
+    if not reserved and not self.reserve():
+      raise QueueFullError
+
+    try:
+      future = self.__pool.submit(fn, *args)
+    except Exception:
+      self.release()
+      raise
+
+    future.add_done_callback(lambda _: self.release())
+    return future
+
+  def release(self):
+    """
+    Gives back a slot, either of a finished task or an unused reservation.
+    """
+    with self.__lock:
+      self.__pending -= 1
+      pending_gauge.dec()
+
+  def shutdown(self, wait: bool = True):
+    self.__pool.shutdown(wait)
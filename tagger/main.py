@@ -1,38 +1,217 @@
-from typing import Optional, Awaitable
+from typing import Any, Callable, Dict, List, Optional, Awaitable
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from tornado.gen import coroutine
-from common.types import ImageData
+from executor import InferenceExecutor, QueueFullError
+from multipart import MultipartParser, MultipartError, parse_boundary
+from model.models import registry
+from common.types import DecodeError
 from common import utils
+import tornado.httpserver
+import tornado.process
+import tornado.netutil
 import tornado.ioloop
 import tornado.web
+import mimetypes
 import analyze
+import threads
+import metrics
+import logging
+import config
+import socket
+import json
+import gc
+import os
 
 MIME_TYPES = ["image/gif", "image/jpeg", "image/png", "image/webp"]
 
+ROUTES = ['/', '/batch', '/duplicates']
+
+request_seconds = {route: metrics.Histogram('tagger_request_seconds', 'Time taken to respond to a request',
+                                            {'route': route}) for route in ROUTES}
+
+log = logging.getLogger('tagger')
+
+
+@tornado.web.stream_request_body
+class BaseHandler(tornado.web.RequestHandler):
+  """
+  Streams request bodies instead of having tornado buffer them. Uploads
+  are parsed as they arrive and, when there is a decoder pool, each image
+  starts decoding as soon as its part of the body is complete.
+
+  Posts take their slot on the inference executor before any of the body
+  is read, so requests that would be turned away with a 503 never stream
+  in or decode their images.
+  """
+  executor: InferenceExecutor
+  decoder: Optional[Executor]
+  parser: Optional[MultipartParser]
+  body: bytearray
+  decoding: Dict[int, Future]
+  malformed: bool
+  reserved: bool
+
+  def initialize(self, executor: InferenceExecutor, decoder: Executor = None):
+    self.executor = executor
+    self.decoder = decoder
+    self.parser = None
+    self.body = bytearray()
+    self.decoding = {}
+    self.malformed = False
+    self.reserved = False
+
+  def prepare(self):
+    self.request.connection.set_max_body_size(config.MAX_BODY_SIZE)
+    try:
+      length = int(self.request.headers.get('Content-Length', '0'))
+    except ValueError:
+      raise tornado.web.HTTPError(400)
+    if length < 0:
+      raise tornado.web.HTTPError(400)
+    if length > config.MAX_BODY_SIZE:
+      raise tornado.web.HTTPError(413)
+
+    if self.request.method == 'POST':
+      if not self.executor.reserve():
+        # whatever arrives of the body is ignored
+        self.malformed = True
+        self.set_status(503)
+        self.set_header('Retry-After', str(config.RETRY_AFTER))
+        self.finish()
+        return
+      self.reserved = True
+
+    boundary = parse_boundary(self.request.headers.get('Content-Type', ''))
+    if boundary is not None:
+      self.parser = MultipartParser(boundary, length, self.__on_part)
 
-class RequestHandler(tornado.web.RequestHandler):
   def data_received(self, chunk: bytes) -> Optional[Awaitable[None]]:
-    return super(RequestHandler, self).data_received(chunk)
+    if self.malformed:
+      return None
+    if self.parser is None:
+      self.body += chunk
+      return None
+
+    try:
+      self.parser.feed(chunk)
+    except MultipartError:
+      # the rest of the body is ignored and the request rejected
+      self.malformed = True
+    return None
 
   @coroutine
-  def get(self):
+  def run_in_executor(self, fn: Callable, *args: Any):
+    """
+    Runs `fn` on the inference executor and writes the result as
+    json. If the executor is full a 503 is sent instead.
+    """
+    # the slot taken in `prepare` is used if there is one
+    reserved, self.reserved = self.reserved, False
+    try:
+      result = yield self.executor.submit(fn, *args, reserved=reserved)
+    except QueueFullError:
+      self.set_status(503)
+      self.set_header('Retry-After', str(config.RETRY_AFTER))
+      return
+    except DecodeError as e:
+      self.write_error_json(422, str(e))
+      return
+
+    with metrics.stage('serialize'):
+      self.write(utils.serialize(result))
+    self.set_header('Content-Type', 'application/json; charset=UTF-8')
     self.set_status(200)
 
+  def write_error_json(self, status: int, message: str):
+    self.write(utils.serialize({'error': message}))
+    self.set_header('Content-Type', 'application/json; charset=UTF-8')
+    self.set_status(status)
+
+  def on_finish(self):
+    self.__release()
+    histogram = request_seconds.get(self.request.path)
+    if histogram is not None and self.request.method == 'POST':
+      histogram.observe(self.request.request_time())
+
+  def get_image_files(self) -> List[dict]:
+    if self.parser is None or self.malformed:
+      return []
+
+    try:
+      parts = self.parser.finish()
+    except MultipartError:
+      return []
+
+    files = [part for part in parts if part['name'] == 'file']
+    if config.EXECUTOR == 'process':
+      # copied out of the request buffer so they can be sent to a process pool
+      return [dict(file, body=bytes(file['body'])) for file in files]
+    return files
+
   @coroutine
-  def post(self):
-    im = self.__validate_post_args()
-    if im is None:
+  def decode_files(self, files: List[dict]):
+    """
+    Swaps in the images that were already decoded while the body was
+    streaming. The rest are decoded on the inference executor. Images
+    that couldn't be decoded are replaced by their `DecodeError`.
+    """
+    decoded = []
+    for file in files:
+      future = self.decoding.get(id(file))
+      try:
+        decoded += [(yield future) if future is not None else file]
+      except DecodeError as e:
+        decoded += [e]
+    return decoded
+
+  def on_connection_close(self):
+    # the client went away before the request was answered
+    super().on_connection_close()
+    self.__release()
+
+  # private methods
+
+  def __release(self):
+    # requests answered without running on the executor give back their slot
+    if self.reserved:
+      self.reserved = False
+      self.executor.release()
+
+  def __on_part(self, part: dict):
+    if self.decoder is None or part['name'] != 'file' or \
+        part['content_type'] not in MIME_TYPES or len(self.decoding) >= config.BATCH_MAX_FILES:
       return
+    self.decoding[id(part)] = self.decoder.submit(analyze.decode_file, part)
+
 
-    result = analyze.run_analysis(im)
-    self.write(utils.serialize(result))
+class RequestHandler(BaseHandler):
+  @coroutine
+  def get(self):
+    # when models are loaded eagerly the tagger isn't ready
+    # until all of them are loaded and warmed up.
+    ready = registry.ready or config.MODEL_LOADING == 'lazy'
+    self.write(utils.serialize({'ready': ready, 'models': registry.status()}))
     self.set_header('Content-Type', 'application/json; charset=UTF-8')
-    self.set_status(200)
+    self.set_status(200 if ready else 503)
+
+  @coroutine
+  def post(self):
+    file = self.__validate_post_args()
+    if file is None:
+      return
+
+    file, = yield self.decode_files([file])
+    if isinstance(file, DecodeError):
+      self.write_error_json(422, str(file))
+      return
+
+    yield self.run_in_executor(analyze.analyze_file, file)
 
   # private methods
 
-  def __validate_post_args(self) -> Optional[ImageData]:
-    files = self.request.files.get('file')
-    if files is None or len(files) != 1:
+  def __validate_post_args(self) -> Optional[dict]:
+    files = self.get_image_files()
+    if len(files) != 1:
       self.set_status(400)
       return None
 
@@ -41,15 +220,220 @@ class RequestHandler(tornado.web.RequestHandler):
       self.set_status(415)
       return None
 
-    return ImageData(file)
+    return file
+
+
+class BatchHandler(BaseHandler):
+  """
+  Analyzes a number of images in one request. The images are either
+  sent as multiple `file` parts of a multipart form, or as a json list
+  of paths to images in `IMAGE_DIR`. The response is a json list with
+  the results for each image in the order they were given. Images that
+  can't be decoded get an `{ error }` entry instead of a result.
+  """
+
+  @coroutine
+  def post(self):
+    content_type = self.request.headers.get('Content-Type', '')
+    if content_type.replace(' ', '').startswith('application/json'):
+      paths = self.__validate_paths()
+      if paths is not None:
+        yield self.run_paths(paths)
+    else:
+      files = self.__validate_files()
+      if files is not None:
+        files = yield self.decode_files(files)
+        yield self.run_files(files)
+
+  def run_files(self, files: List[dict]):
+    return self.run_in_executor(analyze.analyze_files, files)
+
+  def run_paths(self, paths: List[str]):
+    return self.run_in_executor(analyze.analyze_paths, paths)
+
+  # private methods
+
+  def __validate_files(self) -> Optional[List[dict]]:
+    files = self.get_image_files()
+    if len(files) == 0 or len(files) > config.BATCH_MAX_FILES:
+      self.set_status(400)
+      return None
+
+    if any([file['content_type'] not in MIME_TYPES for file in files]):
+      self.set_status(415)
+      return None
+
+    return files
+
+  def __validate_paths(self) -> Optional[List[str]]:
+    """
+    Returns the paths of the images to analyze, relative paths are
+    taken from `IMAGE_DIR`. Paths have to be inside `IMAGE_DIR` (after
+    following any links) so clients can't have other files read.
+    """
+    if not config.IMAGE_DIR:
+      self.set_status(400)
+      return None
+
+    root = os.path.realpath(config.IMAGE_DIR)
+
+    def resolve(p: Any) -> Optional[str]:
+      if not isinstance(p, str):
+        return None
+      try:
+        path = os.path.join(root, p)
+        real = os.path.realpath(path)
+        if os.path.commonpath([root, real]) != root or not os.path.isfile(real):
+          return None
+      except ValueError:
+        # paths with a nul byte in them
+        return None
+      # the given name is kept, the results are keyed by it
+      return path
+
+    try:
+      paths = json.loads(self.body)
+    except ValueError:
+      paths = None
+
+    if not isinstance(paths, list) or len(paths) == 0 or len(paths) > config.BATCH_MAX_FILES:
+      self.set_status(400)
+      return None
+
+    paths = [resolve(p) for p in paths]
+    if any([p is None for p in paths]):
+      self.set_status(400)
+      return None
+
+    if any([mimetypes.guess_type(p)[0] not in MIME_TYPES for p in paths]):
+      self.set_status(415)
+      return None
+
+    return paths
+
+
+class DuplicatesHandler(BatchHandler):
+  """
+  Finds previously analyzed images that are near-duplicates of the
+  given images. Accepts the same input as `BatchHandler` and an optional
+  `distance` argument, the largest hamming distance between the hashes
+  of two images for them to be considered duplicates. The response is
+  a json list of `{ name, distance }` matches for each image, or an
+  `{ error }` entry for images that can't be decoded.
+  """
+
+  def run_files(self, files: List[dict]):
+    return self.run_in_executor(analyze.find_duplicate_files, files, self.__get_distance())
+
+  def run_paths(self, paths: List[str]):
+    return self.run_in_executor(analyze.find_duplicate_paths, paths, self.__get_distance())
+
+  # private methods
+
+  def __get_distance(self) -> int:
+    distance = self.get_argument('distance', str(config.DUPLICATE_SEARCH_DISTANCE))
+    try:
+      return max(0, min(int(distance), 64))
+    except ValueError:
+      raise tornado.web.HTTPError(400)
+
+
+class CacheHandler(tornado.web.RequestHandler):
+  """
+  Reports the hit and miss counts of the result cache and
+  the number of results reused from near-duplicates.
+  """
+
+  @coroutine
+  def get(self):
+    stats = analyze.cache.stats()
+    stats['duplicates'] = analyze.duplicates.stats()
+    self.write(utils.serialize(stats))
+    self.set_header('Content-Type', 'application/json; charset=UTF-8')
+    self.set_status(200)
+
+
+def fork_servers(port: int) -> List[socket.socket]:
+  """
+  Loads the models and forks the server processes, which share the
+  loaded weights copy-on-write. Returns the sockets each of them
+  accepts on.
+  """
+  # onnx runtime sessions own thread pools that don't survive a fork
+  # so those are loaded by each process instead. the other models are
+  # warmed up after forking for the same reason.
+  if config.MODEL_FORMAT != 'onnx':
+    registry.load(warmup=False)
+
+  # moves everything allocated so far out of the garbage collector's
+  # reach so that collections don't dirty the pages shared with the parent.
+  gc.freeze()
+
+  sockets = tornado.netutil.bind_sockets(port)
+  processes = config.SERVER_PROCESSES or tornado.process.cpu_count()
+  index = tornado.process.fork_processes(processes)
+  threads.configure_process(processes, index)
+  return sockets
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+  """
+  Exposes the tagger's metrics in the prometheus text format.
+  """
+
+  @coroutine
+  def get(self):
+    self.write(metrics.render())
+    self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=UTF-8')
+    self.set_status(200)
+
+
+def configure_logging():
+  logging.basicConfig(level=config.LOG_LEVEL.upper(),
+                      format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+  # a line per request is only useful when debugging
+  if logging.getLogger().level > logging.DEBUG:
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
 
 
 if __name__ == "__main__":
+  configure_logging()
+  threads.configure()
+
+  port = config.PORT
+  sockets = fork_servers(port) if config.SERVER_PROCESSES != 1 else None
+
+  if config.MODEL_LOADING == 'eager':
+    if config.EXECUTOR == 'process':
+      # the models are loaded before the pool forks so
+      # that the workers inherit them already loaded.
+      registry.load()
+    else:
+      registry.load_async()
+
+  executor = InferenceExecutor(config.EXECUTOR, config.EXECUTOR_WORKERS,
+                               config.EXECUTOR_QUEUE_SIZE, threads.configure_process)
+  # uploads are decoded while the rest of the request is still streaming
+  # in. process pools decode for themselves since sending them decoded
+  # images would cost more than decoding them.
+  decoder = None
+  if config.EXECUTOR == 'thread':
+    decoder = ThreadPoolExecutor(config.EXECUTOR_WORKERS, thread_name_prefix='decoder')
+
+  handler_args = dict(executor=executor, decoder=decoder)
   app = tornado.web.Application([
-    (r"/", RequestHandler),
+    (r"/", RequestHandler, handler_args),
+    (r"/batch", BatchHandler, handler_args),
+    (r"/duplicates", DuplicatesHandler, handler_args),
+    (r"/cache", CacheHandler),
+    (r"/metrics", MetricsHandler),
   ])
 
-  port = 8888
-  print(f'Server listening on port {port}')
-  app.listen(port)
+  if sockets is not None:
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    log.info(f'Server process {tornado.process.task_id()} listening on port {port}')
+  else:
+    app.listen(port)
+    log.info(f'Server listening on port {port}')
   tornado.ioloop.IOLoop.current().start()
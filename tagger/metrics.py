@@ -0,0 +1,183 @@
+"""
+Metrics exposed in the prometheus text format on `/metrics`.
+
+Every metric keeps its values in shared memory, so metrics created at
+import time (before the server or the inference pool forks) count what
+every process records. Metrics can also read their value from a function
+when it's scraped instead.
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from multiprocessing import Array, Value
+from timeit import default_timer as timer
+import bisect
+import math
+
+Sample = Tuple[str, Dict[str, str], float]
+
+# latency buckets in seconds
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# the stages of an analysis that are timed. preprocess is the resizing
+# and normalizing of the images (crops or whole images) for a classifier.
+STAGES = ['decode', 'yolo', 'preprocess', 'classify', 'analyze_results', 'colors', 'regions', 'serialize']
+
+REGISTRY: List['Metric'] = []
+
+
+class Metric(ABC):
+  type: str
+  name: str
+  help: str
+  labels: Dict[str, str]
+
+  def __init__(self, name: str, help: str, labels: Dict[str, str] = None):
+    self.name = name
+    self.help = help
+    self.labels = labels or {}
+    REGISTRY.append(self)
+
+  @abstractmethod
+  def samples(self) -> List[Sample]:
+    ...
+
+
+class Counter(Metric):
+  type = 'counter'
+
+  def __init__(self, name: str, help: str, labels: Dict[str, str] = None,
+               fn: Callable[[], float] = None):
+    super().__init__(name, help, labels)
+    self.__value = Value('d', 0)
+    self.__fn = fn
+
+  @property
+  def value(self) -> float:
+    return self.__fn() if self.__fn is not None else self.__value.value
+
+  def inc(self, amount: float = 1):
+    with self.__value.get_lock():
+      self.__value.value += amount
+
+  def samples(self) -> List[Sample]:
+    return [('', self.labels, self.value)]
+
+
+class Gauge(Metric):
+  type = 'gauge'
+
+  def __init__(self, name: str, help: str, labels: Dict[str, str] = None,
+               fn: Callable[[], float] = None):
+    super().__init__(name, help, labels)
+    self.__value = Value('d', 0)
+    self.__fn = fn
+
+  @property
+  def value(self) -> float:
+    return self.__fn() if self.__fn is not None else self.__value.value
+
+  def set(self, value: float):
+    self.__value.value = value
+
+  def inc(self, amount: float = 1):
+    with self.__value.get_lock():
+      self.__value.value += amount
+
+  def dec(self, amount: float = 1):
+    self.inc(-amount)
+
+  def samples(self) -> List[Sample]:
+    return [('', self.labels, self.value)]
+
+
+class Histogram(Metric):
+  type = 'histogram'
+  __buckets: List[float]
+
+  def __init__(self, name: str, help: str, labels: Dict[str, str] = None,
+               buckets: List[float] = None):
+    super().__init__(name, help, labels)
+    self.__buckets = sorted(buckets or DEFAULT_BUCKETS)
+    # the count of each bucket (and +Inf), followed by the sum
+    self.__values = Array('d', len(self.__buckets) + 2)
+
+  def observe(self, value: float):
+    i = bisect.bisect_left(self.__buckets, value)
+    with self.__values.get_lock():
+      self.__values[i] += 1
+      self.__values[-1] += value
+
+  @contextmanager
+  def time(self):
+    start = timer()
+    try:
+      yield
+    finally:
+      self.observe(timer() - start)
+
+  def samples(self) -> List[Sample]:
+    with self.__values.get_lock():
+      values = list(self.__values)
+
+    samples = []
+    count = 0
+    for bound, n in zip(self.__buckets + [math.inf], values):
+      count += n
+      le = '+Inf' if bound == math.inf else repr(float(bound))
+      samples += [('_bucket', dict(self.labels, le=le), count)]
+    samples += [('_sum', self.labels, values[-1]), ('_count', self.labels, count)]
+    return samples
+
+
+#
+# Analysis Stages
+#
+
+stage_seconds = {stage: Histogram('tagger_stage_seconds', 'Time spent in each stage of an analysis',
+                                  {'stage': stage}) for stage in STAGES}
+
+
+def stage(name: str):
+  """
+  Times the enclosed block as one run of an analysis stage:
+    `with metrics.stage('decode'): ...`
+  """
+  return stage_seconds[name].time()
+
+
+#
+# Exposition
+#
+
+def format_labels(labels: Dict[str, str]) -> str:
+  if len(labels) == 0:
+    return ''
+
+  def escape(v: str) -> str:
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+  return '{' + ','.join([f'{k}="{escape(v)}"' for k, v in labels.items()]) + '}'
+
+
+def format_value(value: float) -> str:
+  if math.isinf(value):
+    return '+Inf' if value > 0 else '-Inf'
+  return repr(float(value))
+
+
+def render(registry: Optional[List[Metric]] = None) -> str:
+  """
+  Renders every metric in the prometheus text format. Metrics
+  that share a name are rendered together under one header.
+  """
+  families: Dict[str, List[Metric]] = {}
+  for metric in registry if registry is not None else REGISTRY:
+    families.setdefault(metric.name, []).append(metric)
+
+  lines = []
+  for name, family in families.items():
+    lines += [f'# HELP {name} {family[0].help}', f'# TYPE {name} {family[0].type}']
+    for metric in family:
+      for suffix, labels, value in metric.samples():
+        lines += [f'{name}{suffix}{format_labels(labels)} {format_value(value)}']
+  return '\n'.join(lines) + '\n'
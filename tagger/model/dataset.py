@@ -1,28 +1,131 @@
 from __future__ import annotations
-from dataclasses import dataclass
-from typing import Dict, Tuple, List, Any
+from typing import Dict, Tuple, List, Any, Iterable
+from threading import Lock
 from common.utils import intersection, union
 
+# the id of the empty class path, every path starts from it
+ROOT = 0
 
-@dataclass
-class Label:
+
+class ClassIndex(object):
+  """
+  Interns class paths into a trie so every path (and every prefix of one)
+  has an integer id. A label keeps the ids of all of its prefixes as a
+  bitset, which turns comparing two label hierarchies into a couple of
+  integer operations instead of walking their tuples.
+  """
+  __nodes: Dict[Tuple[int, str], int]
+  __words: Dict[str, int]
+  __lock: Lock
+
+  def __init__(self):
+    self.__nodes = {}
+    self.__words = {}
+    self.__lock = Lock()
+
+  @property
+  def size(self) -> int:
+    return len(self.__nodes) + 1
+
+  def path(self, classes: Iterable[str]) -> Tuple[int, int]:
+    """
+    Returns the id of a class path along with the bitset
+    of the ids of all of its prefixes (the root included).
+    """
+    node, ancestors = ROOT, 1 << ROOT
+    for word in classes:
+      child = self.__nodes.get((node, word))
+      if child is None:
+        child = self.__intern(self.__nodes, (node, word))
+      node = child
+      ancestors |= 1 << node
+    return node, ancestors
+
+  def words(self, words: Iterable[str]) -> int:
+    """
+    Returns the bitset of the ids of the given words.
+    """
+    bits = 0
+    for word in words:
+      i = self.__words.get(word)
+      if i is None:
+        i = self.__intern(self.__words, word)
+      bits |= 1 << i
+    return bits
+
+  # private methods
+
+  def __intern(self, table: dict, key: Any) -> int:
+    # labels are created while analyzing, possibly on several threads
+    with self.__lock:
+      return table.setdefault(key, len(table) + 1)
+
+
+index = ClassIndex()
+
+
+class Label(object):
   """
   Represents a label in a dataset.
+
+  Labels are immutable and are equal (and hash the same) when
+  their class paths are, so they can be used as dict keys.
   """
+  __slots__ = ('classes', 'alt', 'related', 'dataset', 'cls', 'id', 'ancestors', 'words', 'related_words')
 
   # the label name and hierarchy
   classes: Tuple[str, ...]
   # alternative words for the label
-  alt: Tuple[str, ...] = tuple()
+  alt: Tuple[str, ...]
   # keywords related to the label
-  related: Tuple[str, ...] = tuple()
+  related: Tuple[str, ...]
   # the dataset that owns this label
-  dataset: Dataset = None
+  dataset: Dataset
   # the class this label represents
-  cls: int = -1
+  cls: int
+  # the interned id of the class path
+  id: int
+  # the bitset of the ids of every prefix of the class path
+  ancestors: int
+  # the bitsets of the words of the class path and of the related words
+  words: int
+  related_words: int
+
+  def __init__(self, classes: Tuple[str, ...], alt: Tuple[str, ...] = tuple(),
+               related: Tuple[str, ...] = tuple(), dataset: Dataset = None, cls: int = -1):
+    node, ancestors = index.path(classes)
+    init = object.__setattr__
+    init(self, 'classes', tuple(classes))
+    init(self, 'alt', tuple(alt))
+    init(self, 'related', tuple(related))
+    init(self, 'dataset', dataset)
+    init(self, 'cls', cls)
+    init(self, 'id', node)
+    init(self, 'ancestors', ancestors)
+    init(self, 'words', index.words(classes))
+    init(self, 'related_words', index.words(related))
+
+  def __setattr__(self, name: str, value: Any):
+    raise AttributeError(f'cannot set {name}, labels are immutable')
+
+  def __delattr__(self, name: str):
+    raise AttributeError(f'cannot delete {name}, labels are immutable')
 
   def __eq__(self, other: Label) -> bool:
-    return self.classes == other.classes
+    if not isinstance(other, Label):
+      return NotImplemented
+    return self.id == other.id
+
+  def __hash__(self) -> int:
+    return self.id
+
+  def __repr__(self) -> str:
+    return f'Label(classes={self.classes!r}, alt={self.alt!r}, related={self.related!r}, ' \
+           f'dataset={self.dataset!r}, cls={self.cls!r})'
+
+  def __reduce__(self):
+    # ids are only meaningful in the process that interned them
+    return Label, (self.classes, self.alt, self.related, self.dataset, self.cls)
 
   @property
   def depth(self) -> int:
@@ -47,6 +150,13 @@ class Label:
 
   #
 
+  def replace(self, **changes: Any) -> Label:
+    """
+    Returns a copy of the label with the given fields changed.
+    """
+    fields = {k: getattr(self, k) for k in ['classes', 'alt', 'related', 'dataset', 'cls']}
+    return Label(**{**fields, **changes})
+
   def common(self, label: Label) -> Tuple[str, ...]:
     """
     Returns the longest sequence of common words found in both
@@ -57,13 +167,8 @@ class Label:
     This would return
       ('animal', 'mammal')
     """
-    words = tuple()
-    for x, y in zip(self.classes, label.classes):
-      if x == y:
-        words += (x,)
-      else:
-        break
-    return words
+    # the shared prefixes of two paths are the common path and the root
+    return self.classes[:bin(self.ancestors & label.ancestors).count('1') - 1]
 
   def intersection(self, label: Label) -> Label:
     classes = tuple(intersection(self.classes, label.classes))
@@ -78,14 +183,10 @@ class Label:
     return Label(classes, alt=alt, related=related, dataset=self.dataset, cls=self.cls)
 
   def is_related(self, label: Label) -> bool:
-    for related in self.related:
-      if related in label.classes:
-        return True
-    return False
+    return (self.related_words & label.words) != 0
 
   def is_parent(self, label: Label) -> bool:
-    common = self.common(label)
-    return common == self.classes
+    return (label.ancestors >> self.id) & 1 == 1
 
 
 class Dataset(object):
@@ -96,6 +197,7 @@ class Dataset(object):
   __labels: List[(int, Label)]
   __relations: Dict[str, List[str]]
   __names: Dict[str, List[Label]]
+  __ids: Dict[int, Label]
   __registered: bool
 
   def __init__(self, name: str):
@@ -103,6 +205,7 @@ class Dataset(object):
     self.__labels = []
     self.__relations = {}
     self.__names = {}
+    self.__ids = {}
     self.__registered = False
 
   def __contains__(self, item: Any) -> bool:
@@ -153,15 +256,23 @@ class Dataset(object):
       self.__relations[word2] = [word1]
 
   def register(self, labels: List[Label]):
+    """
+    Registers the labels of the dataset in order of their class. Each
+    is replaced (in `labels` too) by a copy owned by the dataset, with
+    the words related to its class path added, and its class path is
+    interned in the label index.
+    """
     assert not self.__registered
-    for index, label in enumerate(labels):
-      label.dataset = self
-      label.cls = index
+    for cls, label in enumerate(labels):
+      related = label.related
       for word in label.classes:
         if word in self.__relations:
-          self.__relate_label(label, self.__relations[word])
+          related = self.__relate_words(related, self.__relations[word])
 
-      self.__labels += [(index, label)]
+      label = label.replace(related=related, dataset=self, cls=cls)
+      labels[cls] = label
+      self.__labels += [(cls, label)]
+      self.__ids[label.id] = label
       if label.name in self.__names:
         self.__names[label.name] += [label]
       else:
@@ -172,19 +283,15 @@ class Dataset(object):
   #
 
   def __check_contains(self, label: Label) -> bool:
-    name = label.name
-    if name in self.__names:
-      labels = self.__names[name]
-      return any([l == label for l in labels])
+    return label.id in self.__ids
 
   def __get_label(self, index: int) -> Label:
     _, label = self.__labels[index]
     return label
 
-  def __relate_label(self, label: Label, words: List[str]):
+  @staticmethod
+  def __relate_words(related: Tuple[str, ...], words: List[str]) -> Tuple[str, ...]:
     for word in words:
-      if label.related:
-        if word not in label.related:
-          label.related += (word,)
-      else:
-        label.related = (word,)
+      if word not in related:
+        related += (word,)
+    return related
@@ -0,0 +1,101 @@
+from typing import Any, Callable, List, Union
+from PIL import Image
+import torchvision
+import numpy as np
+import torch
+import cv2
+
+ImageInput = Union[Image.Image, np.ndarray]
+
+
+class Detections:
+  """
+  The output of a `Detector`, laid out like the output of the yolov5
+  hub model so that the two can be used interchangeably.
+  """
+  # a [N, 6] tensor (x1, y1, x2, y2, conf, cls) for each image
+  pred: List[torch.Tensor]
+
+  def __init__(self, pred: List[torch.Tensor]):
+    self.pred = pred
+
+
+class Detector(object):
+  """
+  Wraps the raw forward of an exported yolo network with the same
+  letterboxing and non-max suppression the yolov5 hub model does, so
+  exported models can be called just like the eager hub model:
+    `detector(imgs, size=640).pred`
+
+  The exported network only accepts `size` x `size` inputs, so every
+  image is letterboxed into a square.
+  """
+  __forward: Callable[[torch.Tensor], Any]
+  __size: int
+  __conf: float
+  __iou: float
+  __max_det: int
+
+  def __init__(self, forward: Callable[[torch.Tensor], Any], size: int = 640,
+               conf: float = 0.25, iou: float = 0.45, max_det: int = 300):
+    self.__forward = forward
+    self.__size = size
+    self.__conf = conf
+    self.__iou = iou
+    self.__max_det = max_det
+
+  def __call__(self, imgs: List[ImageInput], size: int = 640) -> Detections:
+    assert size == self.__size, f'exported model only accepts {self.__size}px inputs'
+
+    arrs = [np.asarray(img) for img in imgs]
+    inputs, scales, offsets = zip(*[self.__letterbox(arr) for arr in arrs])
+    tensor = torch.from_numpy(np.stack(inputs)).permute(0, 3, 1, 2).float() / 255
+
+    with torch.no_grad():
+      output = self.__forward(tensor)
+    if isinstance(output, (tuple, list)):
+      output = output[0]
+    output = torch.as_tensor(output)
+
+    pred = []
+    for p, arr, scale, offset in zip(output, arrs, scales, offsets):
+      pred += [self.__postprocess(p, arr.shape[:2], scale, offset)]
+    return Detections(pred)
+
+  # private methods
+
+  def __letterbox(self, img: np.ndarray):
+    h, w = img.shape[:2]
+    scale = self.__size / max(h, w)
+    nh, nw = max(1, round(h * scale)), max(1, round(w * scale))
+
+    resized = cv2.resize(img[:, :, :3], (nw, nh), interpolation=cv2.INTER_LINEAR)
+
+    # the padding is split and rounded like yolov5's `letterbox`, an odd
+    # padding puts the extra pixel after the image. boxes are mapped back
+    # with the unrounded padding like its `scale_coords` does.
+    dw, dh = (self.__size - nw) / 2, (self.__size - nh) / 2
+    top, left = int(round(dh - 0.1)), int(round(dw - 0.1))
+    # yolov5 pads with gray
+    out = np.full((self.__size, self.__size, 3), 114, dtype=np.uint8)
+    out[top:top + nh, left:left + nw] = resized
+    return out, scale, ((self.__size - w * scale) / 2, (self.__size - h * scale) / 2)
+
+  def __postprocess(self, pred: torch.Tensor, shape, scale: float, offset) -> torch.Tensor:
+    # pred is [N, 5 + classes] of (cx, cy, w, h, obj, class scores...)
+    pred = pred[pred[:, 4] > self.__conf]
+    scores = pred[:, 5:] * pred[:, 4:5]
+    conf, cls = scores.max(1)
+    keep = conf > self.__conf
+    pred, conf, cls = pred[keep], conf[keep], cls[keep]
+
+    cx, cy, w, h = pred[:, 0], pred[:, 1], pred[:, 2], pred[:, 3]
+    boxes = torch.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], dim=1)
+    keep = torchvision.ops.batched_nms(boxes, conf, cls, self.__iou)[:self.__max_det]
+    boxes, conf, cls = boxes[keep], conf[keep], cls[keep]
+
+    # map the boxes back onto the original image
+    left, top = offset
+    boxes[:, [0, 2]] = ((boxes[:, [0, 2]] - left) / scale).clamp(0, shape[1])
+    boxes[:, [1, 3]] = ((boxes[:, [1, 3]] - top) / scale).clamp(0, shape[0])
+    return torch.cat([boxes, conf[:, None], cls[:, None].float()], dim=1)
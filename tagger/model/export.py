@@ -0,0 +1,91 @@
+"""
+Exports the tagger models to frozen TorchScript modules or onnx graphs
+so they can be loaded with `TAGGER_MODEL_FORMAT=torchscript` or `onnx`.
+Run from the tagger directory after the models have been downloaded:
+  python -m model.export [--format torchscript|onnx]
+"""
+from typing import Any
+from model import models
+import torch.nn as nn
+import argparse
+import torch
+
+FORMATS = ['torchscript', 'onnx']
+
+ONNX_OPSET = 11
+
+
+def fuse_conv_bn(module: nn.Module) -> nn.Module:
+  """
+  Folds every batch norm that directly follows a convolution in a
+  `Sequential` into the convolution's weights.
+  """
+  for name, child in module.named_children():
+    fuse_conv_bn(child)
+
+  if isinstance(module, nn.Sequential):
+    children = list(module._modules.items())
+    for (a_name, a), (b_name, b) in zip(children, children[1:]):
+      if isinstance(a, nn.Conv2d) and isinstance(b, nn.BatchNorm2d):
+        module._modules[a_name] = nn.utils.fusion.fuse_conv_bn_eval(a, b)
+        module._modules[b_name] = nn.Identity()
+
+  return module
+
+
+def export_module(module: nn.Module, example: torch.Tensor, path: str) -> Any:
+  module = fuse_conv_bn(module.eval())
+  with torch.no_grad():
+    traced = torch.jit.trace(module, example)
+
+  # freezing inlines the weights as constants so the remaining ops
+  # can be folded. the cpu specific optimizations are done at load
+  # time since their output can't always be serialized.
+  frozen = torch.jit.freeze(traced)
+  torch.jit.save(frozen, path)
+  print(f'Exported {path}')
+  return frozen
+
+
+def export_onnx(module: nn.Module, example: torch.Tensor, path: str):
+  module = fuse_conv_bn(module.eval())
+  # the batch dimension is left dynamic so batches of any size
+  # can be run through a single onnx runtime session.
+  with torch.no_grad():
+    torch.onnx.export(module, example, path, opset_version=ONNX_OPSET,
+                      input_names=['input'], output_names=['output'],
+                      dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}})
+  print(f'Exported {path}')
+
+
+def export(module: nn.Module, example: torch.Tensor, name: str, fmt: str):
+  if fmt == 'onnx':
+    export_onnx(module, example, models.local_path(f'{name}.onnx'))
+  else:
+    export_module(module, example, models.local_path(f'{name}.torchscript.pt'))
+
+
+def export_yolo(fmt: str = 'torchscript'):
+  # only the network inside the hub model is exported, the
+  # letterboxing and nms are done by `Detector` instead.
+  network = models.load_yolo().model
+  if hasattr(network, 'fuse'):
+    network = network.fuse()
+
+  size = models.YOLO_INPUT_SIZE
+  export(network, torch.zeros(1, 3, size, size), 'yolov5s', fmt)
+
+
+def export_imagenet_model(name: str, fmt: str = 'torchscript'):
+  size = models.INPUT_SIZE
+  export(models.load_imagenet_model(name), torch.zeros(1, 3, size, size), name, fmt)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Exports the tagger models.')
+  parser.add_argument('--format', choices=FORMATS, default='torchscript')
+  args = parser.parse_args()
+
+  export_yolo(args.format)
+  export_imagenet_model('mobilenet_v2', args.format)
+  export_imagenet_model('shufflenet_v2_x1_0', args.format)
@@ -1,8 +1,26 @@
-from typing import Any
+from typing import Any, Callable, Dict, List
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from threading import Thread, Lock
+from timeit import default_timer as timer
+from enum import Enum
 from model.dataset import Label
+from model.detector import Detector
+from model.runtime import OnnxModel
 from box import Box
+import numpy as np
+import torchvision
+import threads
+import logging
+import config
+import shutil
 import torch
+import sys
+import os
+
+
+log = logging.getLogger(__name__)
 
 
 #
@@ -37,28 +55,333 @@ class BoxResult(NetResult):
   bbox: Box
 
 
+#
+# Model Registry
+#
+
+class ModelState(Enum):
+  UNLOADED = 'unloaded'
+  LOADING = 'loading'
+  LOADED = 'loaded'
+  READY = 'ready'
+  FAILED = 'failed'
+
+
+class ModelRegistry(object):
+  """
+  Keeps track of the models used by the tagger. Models are loaded
+  either lazily on first use or all at once (in parallel) with `load`.
+  Once a model is loaded it is run on a dummy input so the first real
+  request doesn't pay for any one-time initialization. Models loaded
+  without warming up are warmed up the first time they're used.
+  """
+  __loaders: Dict[str, Callable[[], Any]]
+  __warmups: Dict[str, Callable[[Any], None]]
+  __models: Dict[str, Any]
+  __states: Dict[str, ModelState]
+  __locks: Dict[str, Lock]
+
+  def __init__(self):
+    self.__loaders = {}
+    self.__warmups = {}
+    self.__models = {}
+    self.__states = {}
+    self.__locks = {}
+
+  def __contains__(self, name: str) -> bool:
+    return name in self.__loaders
+
+  #
+
+  @property
+  def ready(self) -> bool:
+    """
+    Whether every registered model is loaded and warmed up.
+    """
+    return all([s == ModelState.READY for s in self.__states.values()])
+
+  def status(self) -> Dict[str, str]:
+    return {name: state.value for name, state in self.__states.items()}
+
+  #
+
+  def register(self, name: str, loader: Callable[[], Any],
+               warmup: Callable[[Any], None] = None):
+    self.__loaders[name] = loader
+    self.__warmups[name] = warmup
+    self.__states[name] = ModelState.UNLOADED
+    self.__locks[name] = Lock()
+    self.__models.pop(name, None)
+
+  def get(self, name: str) -> Any:
+    """
+    Returns a model, loading it first if it hasn't been yet.
+    """
+    if self.__states[name] == ModelState.READY:
+      return self.__models[name]
+    return self.__get(name, True)
+
+  def load(self, names: List[str] = None, parallel: bool = True, warmup: bool = True):
+    """
+    Loads and warms up the given models (or all of them). Models
+    that aren't warmed up are left in the `LOADED` state.
+    """
+    names = names or list(self.__loaders.keys())
+    if not parallel:
+      for name in names:
+        self.__get(name, warmup)
+      return
+
+    with ThreadPoolExecutor(len(names), thread_name_prefix='model-loader') as pool:
+      for future in [pool.submit(self.__get, name, warmup) for name in names]:
+        future.result()
+
+  def load_async(self, names: List[str] = None, parallel: bool = True) -> Thread:
+    thread = Thread(target=self.load, args=(names, parallel), daemon=True)
+    thread.start()
+    return thread
+
+  # private methods
+
+  def __get(self, name: str, warmup: bool) -> Any:
+    with self.__locks[name]:
+      if name not in self.__models:
+        self.__load(name)
+      if warmup and self.__states[name] == ModelState.LOADED:
+        self.__warmup(name)
+      return self.__models[name]
+
+  def __load(self, name: str):
+    self.__states[name] = ModelState.LOADING
+    try:
+      start = timer()
+      model = self.__loaders[name]()
+      end = timer()
+    except BaseException:
+      self.__states[name] = ModelState.FAILED
+      raise
+
+    log.info(f'Loaded {name} in {end - start} seconds')
+    self.__models[name] = model
+    self.__states[name] = ModelState.LOADED
+
+  def __warmup(self, name: str):
+    warmup = self.__warmups[name]
+    try:
+      if warmup is not None:
+        warmup(self.__models[name])
+    except BaseException:
+      self.__states[name] = ModelState.FAILED
+      raise
+
+    self.__states[name] = ModelState.READY
+
+
 #
 # Model Loading
 #
 
+# the size of the square input fed to the imagenet classifiers
+INPUT_SIZE = 256
+# the size of the longest side of the images fed to yolo
+YOLO_INPUT_SIZE = 640
+
+YOLO_REPO = 'ultralytics/yolov5'
+VISION_REPO = 'pytorch/vision:v0.6.0'
+
+
+def local_path(*parts: str) -> str:
+  return os.path.join(config.MODEL_DIR, *parts)
+
+
 def load_yolo() -> Any:
-  model = torch.hub.load('ultralytics/yolov5', 'yolov5s', pretrained=True)
+  repo_dir = local_path('yolov5')
+  weights = local_path('yolov5s.pt')
+  if not os.path.exists(weights):
+    raise FileNotFoundError(f'{weights} not found, run `python -m model.models` to download it')
+
+  # the pickled model references modules in the yolov5 source tree.
+  # it's the whole hub model rather than a state dict, so it can't be
+  # loaded with weights_only (the default since torch 2.6).
+  if repo_dir not in sys.path:
+    sys.path.insert(0, repo_dir)
+  model = torch.load(weights, map_location='cpu', weights_only=False)
   # model.eval()
   return model
 
 
-def load_mobilenet() -> Any:
-  model = torch.hub.load('pytorch/vision:v0.6.0', 'mobilenet_v2', pretrained=True)
+def load_imagenet_model(name: str) -> Any:
+  weights = local_path(f'{name}.pth')
+  if not os.path.exists(weights):
+    raise FileNotFoundError(f'{weights} not found, run `python -m model.models` to download it')
+
+  model = getattr(torchvision.models, name)(weights=None)
+  model.load_state_dict(torch.load(weights, map_location='cpu', weights_only=True))
   model.eval()
   return model
 
 
-def load_shufflenet() -> Any:
-  model = torch.hub.load('pytorch/vision:v0.6.0', 'shufflenet_v2_x1_0', pretrained=True)
+def load_torchscript(name: str) -> Any:
+  path = local_path(f'{name}.torchscript.pt')
+  if not os.path.exists(path):
+    raise FileNotFoundError(f'{path} not found, run `python -m model.export` to create it')
+
+  model = torch.jit.load(path, map_location='cpu')
   model.eval()
+  if hasattr(torch.jit, 'optimize_for_inference'):
+    model = torch.jit.optimize_for_inference(model)
   return model
 
 
-yolo = load_yolo()
-mobilenet = load_mobilenet()
-shufflenet = load_shufflenet()
+def load_quantized(name: str, mode: str) -> Any:
+  """
+  Loads an int8 version of an imagenet model. Statically quantized
+  models have to be built ahead of time with `python -m model.quantize`
+  since they need calibration images, while dynamically quantized
+  models are built on the fly if they don't exist.
+  """
+  if os.path.exists(local_path(f'{name}.{mode}-int8.torchscript.pt')):
+    return load_torchscript(f'{name}.{mode}-int8')
+  elif mode == 'dynamic':
+    model = load_imagenet_model(name)
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+  raise FileNotFoundError(f'{name} has not been quantized, run '
+                          f'`python -m model.quantize build <images>` to create it')
+
+
+def load_onnx(name: str) -> OnnxModel:
+  path = local_path(f'{name}.onnx')
+  if not os.path.exists(path):
+    raise FileNotFoundError(f'{path} not found, run `python -m model.export --format onnx` to create it')
+  # unless set explicitly, onnx runtime gets the same share of
+  # cores as torch would so the two budgets are interchangeable.
+  intra_op = config.ORT_INTRA_OP_THREADS
+  if intra_op <= 0 and threads.current is not None:
+    intra_op = threads.current.intra_op
+  return OnnxModel(path, intra_op, config.ORT_INTER_OP_THREADS)
+
+
+#
+# Model Backends
+#
+
+class Backend(ABC):
+  """
+  A way of running the tagger models. Every backend loads models with
+  the same interface: detectors are called like the yolov5 hub model
+  (`model(imgs, size=640).pred`) and classifiers take a batch of
+  normalized images and return their logits.
+  """
+
+  @abstractmethod
+  def load_detector(self) -> Any:
+    ...
+
+  @abstractmethod
+  def load_classifier(self, name: str) -> Any:
+    ...
+
+
+class EagerBackend(Backend):
+  def load_detector(self) -> Any:
+    return load_yolo()
+
+  def load_classifier(self, name: str) -> Any:
+    return load_imagenet_model(name)
+
+
+class TorchScriptBackend(Backend):
+  def load_detector(self) -> Any:
+    return Detector(load_torchscript('yolov5s'), YOLO_INPUT_SIZE)
+
+  def load_classifier(self, name: str) -> Any:
+    return load_torchscript(name)
+
+
+class OnnxBackend(Backend):
+  def load_detector(self) -> Any:
+    return Detector(load_onnx('yolov5s'), YOLO_INPUT_SIZE)
+
+  def load_classifier(self, name: str) -> Any:
+    return load_onnx(name)
+
+
+BACKENDS = {
+  'eager': EagerBackend(),
+  'torchscript': TorchScriptBackend(),
+  'onnx': OnnxBackend(),
+}
+
+
+def get_backend() -> Backend:
+  if config.MODEL_FORMAT not in BACKENDS:
+    raise ValueError(f'unknown model format: {config.MODEL_FORMAT}')
+  return BACKENDS[config.MODEL_FORMAT]
+
+
+def load_coco_model() -> Any:
+  return get_backend().load_detector()
+
+
+def load_classifier(key: str, name: str) -> Any:
+  # quantized models are always run with torch
+  mode = config.QUANTIZE.get(key)
+  if mode is not None:
+    return load_quantized(name, mode)
+  return get_backend().load_classifier(name)
+
+
+def load_mobilenet() -> Any:
+  return load_classifier('mobilenet', 'mobilenet_v2')
+
+
+def load_shufflenet() -> Any:
+  return load_classifier('shufflenet', 'shufflenet_v2_x1_0')
+
+
+def fetch_yolo():
+  """
+  Downloads yolo from torch hub and saves the model along with
+  the source tree it depends on into the model directory.
+  """
+  log.info(f'Downloading {YOLO_REPO} into {config.MODEL_DIR}')
+  model = torch.hub.load(YOLO_REPO, 'yolov5s', pretrained=True)
+  os.makedirs(config.MODEL_DIR, exist_ok=True)
+
+  owner, repo = YOLO_REPO.split('/')
+  hub_dir = os.path.join(torch.hub.get_dir(), f'{owner}_{repo}_master')
+  shutil.copytree(hub_dir, local_path('yolov5'), dirs_exist_ok=True)
+  torch.save(model, local_path('yolov5s.pt'))
+
+
+def fetch_imagenet_model(name: str):
+  log.info(f'Downloading {name} into {config.MODEL_DIR}')
+  model = torch.hub.load(VISION_REPO, name, pretrained=True)
+  os.makedirs(config.MODEL_DIR, exist_ok=True)
+  torch.save(model.state_dict(), local_path(f'{name}.pth'))
+
+
+def warmup_yolo(model: Any):
+  size = YOLO_INPUT_SIZE
+  model([np.zeros((size, size, 3), dtype=np.uint8)], size=size)
+
+
+def warmup_imagenet_model(model: Any):
+  with torch.no_grad():
+    model(torch.zeros(1, 3, INPUT_SIZE, INPUT_SIZE))
+
+
+registry = ModelRegistry()
+registry.register('yolo', load_coco_model, warmup_yolo)
+registry.register('mobilenet', load_mobilenet, warmup_imagenet_model)
+registry.register('shufflenet', load_shufflenet, warmup_imagenet_model)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  # downloads all of the models into the model directory so
+  # that the tagger never needs network access to start.
+  fetch_yolo()
+  fetch_imagenet_model('mobilenet_v2')
+  fetch_imagenet_model('shufflenet_v2_x1_0')
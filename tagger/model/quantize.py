@@ -0,0 +1,161 @@
+"""
+Builds int8 versions of the imagenet classifiers and compares them
+against the fp32 models. Run from the tagger directory:
+  python -m model.quantize build <calibration images>
+  python -m model.quantize compare <images>
+
+The quantized models are used by setting `TAGGER_QUANTIZE`, e.g.
+`TAGGER_QUANTIZE=mobilenet=static,shufflenet=dynamic`.
+"""
+from typing import Any, Dict, List, Tuple
+from timeit import default_timer as timer
+from model.export import export_module
+from model import models
+from predict import preprocess
+from PIL import Image
+import numpy as np
+import torchvision
+import argparse
+import torch
+import io
+import os
+
+MODELS = {
+  'mobilenet': 'mobilenet_v2',
+  'shufflenet': 'shufflenet_v2_x1_0',
+}
+
+MODES = ['static', 'dynamic']
+
+
+def load_images(folder: str, limit: int) -> List[torch.Tensor]:
+  tensors = []
+  for file in sorted(os.listdir(folder)):
+    try:
+      img = Image.open(os.path.join(folder, file)).convert('RGB')
+    except OSError:
+      continue
+
+    tensors += [preprocess(np.asarray(img))]
+    if len(tensors) >= limit:
+      break
+
+  if len(tensors) == 0:
+    raise ValueError(f'no images found in {folder}')
+  return tensors
+
+
+def quantize_static(name: str, calibration: List[torch.Tensor]) -> Any:
+  """
+  Post-training static quantization. The observers inserted into the
+  model record the range of the activations over the calibration set,
+  which is then used to quantize both the weights and activations.
+  """
+  model = getattr(torchvision.models.quantization, name)(weights=None, quantize=False)
+  model.load_state_dict(models.load_imagenet_model(name).state_dict())
+  model.eval()
+  model.fuse_model()
+
+  model.qconfig = torch.quantization.get_default_qconfig(torch.backends.quantized.engine)
+  torch.quantization.prepare(model, inplace=True)
+  with torch.no_grad():
+    for batch in torch.split(torch.stack(calibration), 8):
+      model(batch)
+
+  torch.quantization.convert(model, inplace=True)
+  return model
+
+
+def quantize_dynamic(name: str) -> Any:
+  """
+  Dynamic quantization. Only the weights of the linear layers are
+  quantized ahead of time, so it needs no calibration but does a lot
+  less for convolutional networks than static quantization.
+  """
+  model = models.load_imagenet_model(name)
+  return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def build(folder: str, limit: int):
+  calibration = load_images(folder, limit)
+  size = models.INPUT_SIZE
+  example = torch.zeros(1, 3, size, size)
+
+  for name in MODELS.values():
+    export_module(quantize_static(name, calibration), example,
+                  models.local_path(f'{name}.static-int8.torchscript.pt'))
+    export_module(quantize_dynamic(name), example,
+                  models.local_path(f'{name}.dynamic-int8.torchscript.pt'))
+
+
+#
+# Comparison
+#
+
+def model_size(name: str, model: Any) -> int:
+  """
+  The size of a model's serialized weights in bytes. Exported models
+  are measured on disk since the optimizations applied when they're
+  loaded change how their weights are stored.
+  """
+  path = models.local_path(f'{name}.torchscript.pt')
+  if isinstance(model, torch.jit.ScriptModule) and os.path.exists(path):
+    return os.path.getsize(path)
+
+  buffer = io.BytesIO()
+  torch.save(model.state_dict(), buffer)
+  return buffer.tell()
+
+
+def run_model(model: Any, tensors: List[torch.Tensor]) -> Tuple[List[int], float]:
+  """
+  Runs each image through the model on its own and returns the top-1
+  classes along with the mean latency in seconds.
+  """
+  classes = []
+  elapsed = 0
+  with torch.no_grad():
+    model(tensors[0].unsqueeze(0))
+    for tensor in tensors:
+      start = timer()
+      output = model(tensor.unsqueeze(0))
+      elapsed += timer() - start
+      classes += [int(output[0].argmax().item())]
+  return classes, elapsed / len(tensors)
+
+
+def compare(folder: str, limit: int):
+  tensors = load_images(folder, limit)
+  print(f'Comparing on {len(tensors)} images\n')
+  print(f'{"model":<12} {"variant":<14} {"agreement":>10} {"latency":>12} {"size":>10}')
+
+  for key, name in MODELS.items():
+    variants: Dict[str, Any] = {'fp32': models.load_imagenet_model(name)}
+    for mode in MODES:
+      try:
+        variants[f'{mode}-int8'] = models.load_quantized(name, mode)
+      except FileNotFoundError as e:
+        print(f'skipping {key} {mode}-int8: {e}')
+
+    reference = None
+    for variant, model in variants.items():
+      classes, latency = run_model(model, tensors)
+      reference = reference or classes
+      agreement = sum([a == b for a, b in zip(classes, reference)]) / len(classes)
+
+      artifact = name if variant == 'fp32' else f'{name}.{variant}'
+      size = model_size(artifact, model) / (1024 * 1024)
+      print(f'{key:<12} {variant:<14} {agreement:>9.1%} {latency * 1000:>10.2f}ms {size:>8.2f}MB')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Quantizes the imagenet classifiers to int8.')
+  parser.add_argument('command', choices=['build', 'compare'])
+  parser.add_argument('folder', help='a folder of images to calibrate or compare with')
+  parser.add_argument('--limit', type=int, default=100, help='the most images to use')
+  args = parser.parse_args()
+
+  if args.command == 'build':
+    build(args.folder, args.limit)
+  else:
+    compare(args.folder, args.limit)
@@ -0,0 +1,40 @@
+from typing import Any
+import numpy as np
+import torch
+
+try:
+  import onnxruntime
+except ImportError:
+  onnxruntime = None
+
+
+class OnnxModel(object):
+  """
+  Runs an exported onnx model with onnx runtime. It takes and returns
+  torch tensors so it can be used in place of the torch models.
+  """
+  __session: Any
+  __input: str
+
+  def __init__(self, path: str, intra_op_threads: int = 0, inter_op_threads: int = 0):
+    if onnxruntime is None:
+      raise ImportError('onnxruntime is required to run onnx models, `pip install -r requirements-onnx.txt`')
+
+    # a thread count of 0 lets onnx runtime pick one for itself
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    self.__session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+    self.__input = self.__session.get_inputs()[0].name
+
+  def __call__(self, tensor: torch.Tensor) -> Any:
+    inputs = np.ascontiguousarray(tensor.numpy(), dtype=np.float32)
+    outputs = self.__session.run(None, {self.__input: inputs})
+    outputs = [torch.from_numpy(output) for output in outputs]
+    return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+  def eval(self) -> 'OnnxModel':
+    return self
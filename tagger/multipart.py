@@ -0,0 +1,202 @@
+from typing import Callable, Dict, List, Optional, Tuple
+from email.message import Message
+from email.utils import collapse_rfc2231_value
+from tornado.httputil import HTTPHeaders
+
+# the states of the parser
+PREAMBLE = 0
+DELIMITER = 1
+HEADERS = 2
+BODY = 3
+DONE = 4
+
+
+class MultipartError(Exception):
+  """
+  Raised when a multipart body is malformed or larger than expected.
+  """
+  pass
+
+
+class MultipartParser(object):
+  """
+  Parses a `multipart/form-data` body incrementally as it's received.
+
+  When the size of the body is known up front it's copied into a buffer
+  of that size and the body of every part is a memoryview into it, so
+  an upload is only ever held in memory once. Each part is passed to
+  `on_part` as soon as its closing boundary arrives. Otherwise the buffer
+  grows as chunks arrive and the parts are only available once it's done.
+
+  Parts are dicts with the same `name`, `filename`, `content_type` and
+  `body` fields as the files tornado parses.
+  """
+  __delimiter: bytes
+  __buffer: bytearray
+  __fixed: bool
+  __length: int
+  __pos: int
+  __state: int
+  __part: Optional[dict]
+  __part_start: int
+  __parts: List[dict]
+  __on_part: Optional[Callable[[dict], None]]
+
+  def __init__(self, boundary: bytes, size: int = 0, on_part: Callable[[dict], None] = None):
+    self.__delimiter = b'--' + boundary
+    self.__buffer = bytearray(size)
+    self.__fixed = size > 0
+    self.__length = 0
+    self.__pos = 0
+    self.__state = PREAMBLE
+    self.__part = None
+    self.__part_start = 0
+    self.__parts = []
+    self.__on_part = on_part if self.__fixed else None
+
+  #
+
+  @property
+  def done(self) -> bool:
+    return self.__state == DONE
+
+  @property
+  def parts(self) -> List[dict]:
+    return self.__parts
+
+  #
+
+  def feed(self, chunk: bytes):
+    if self.__fixed:
+      end = self.__length + len(chunk)
+      if end > len(self.__buffer):
+        raise MultipartError('body is larger than its content length')
+      self.__buffer[self.__length:end] = chunk
+      self.__length = end
+    else:
+      self.__buffer += chunk
+      self.__length += len(chunk)
+
+    while self.__state != DONE and self.__step():
+      pass
+
+  def finish(self) -> List[dict]:
+    """
+    Returns every part of the body, raising a `MultipartError`
+    if the closing boundary was never received.
+    """
+    if self.__state != DONE:
+      raise MultipartError('body ended before the closing boundary')
+
+    if not self.__fixed:
+      # the buffer can't grow any more so views into it are safe now
+      view = memoryview(self.__buffer)
+      for part in self.__parts:
+        start, end = part['body']
+        part['body'] = view[start:end]
+    return self.__parts
+
+  # private methods
+
+  def __find(self, sub: bytes, start: int) -> int:
+    return self.__buffer.find(sub, start, self.__length)
+
+  def __step(self) -> bool:
+    """
+    Advances the parser by one state, returning
+    whether there was enough data to do so.
+    """
+    if self.__state == PREAMBLE:
+      i = self.__find(self.__delimiter, self.__pos)
+      if i < 0:
+        return False
+      self.__pos = i + len(self.__delimiter)
+      self.__state = DELIMITER
+
+    elif self.__state == DELIMITER:
+      if self.__length - self.__pos < 2:
+        return False
+      marker = bytes(self.__buffer[self.__pos:self.__pos + 2])
+      if marker == b'--':
+        self.__state = DONE
+      elif marker == b'\r\n':
+        self.__pos += 2
+        self.__state = HEADERS
+      else:
+        raise MultipartError('invalid boundary')
+
+    elif self.__state == HEADERS:
+      i = self.__find(b'\r\n\r\n', self.__pos)
+      if i < 0:
+        return False
+      try:
+        headers = HTTPHeaders.parse(self.__buffer[self.__pos:i].decode('utf-8'))
+      except UnicodeDecodeError:
+        raise MultipartError('part headers are not utf-8')
+      self.__part = MultipartParser.__make_part(headers)
+      self.__pos = self.__part_start = i + 4
+      self.__state = BODY
+
+    elif self.__state == BODY:
+      end = b'\r\n' + self.__delimiter
+      i = self.__find(end, self.__pos)
+      if i < 0:
+        # only the tail could hold the start of the boundary
+        self.__pos = max(self.__part_start, self.__length - len(end) + 1)
+        return False
+
+      self.__end_part(i)
+      self.__pos = i + len(end)
+      self.__state = DELIMITER
+
+    return True
+
+  def __end_part(self, end: int):
+    part = self.__part
+    self.__part = None
+    if part is None:
+      return
+
+    if self.__fixed:
+      part['body'] = memoryview(self.__buffer)[self.__part_start:end]
+    else:
+      part['body'] = (self.__part_start, end)
+
+    self.__parts += [part]
+    if self.__on_part is not None:
+      self.__on_part(part)
+
+  @staticmethod
+  def __make_part(headers: HTTPHeaders) -> Optional[dict]:
+    # only file parts are kept, like `request.files`
+    disposition, params = parse_header(headers.get('Content-Disposition', ''))
+    if disposition != 'form-data' or 'filename' not in params:
+      return None
+
+    return {
+      'name': params.get('name'),
+      'filename': params['filename'],
+      'content_type': headers.get('Content-Type', 'application/unknown'),
+    }
+
+
+def parse_header(line: str) -> Tuple[str, Dict[str, str]]:
+  """
+  Splits a header like `form-data; name="file"` into its value and a
+  dict of its (unquoted) parameters.
+  """
+  message = Message()
+  message['header'] = line
+  params = message.get_params(header='header') or [('', '')]
+  value, _ = params[0]
+  return value, {k: collapse_rfc2231_value(v) for k, v in params[1:]}
+
+
+def parse_boundary(content_type: str) -> Optional[bytes]:
+  """
+  Returns the boundary of a `multipart/form-data` content type.
+  """
+  value, params = parse_header(content_type)
+  if value != 'multipart/form-data' or not params.get('boundary'):
+    return None
+  return params['boundary'].encode('latin1')
@@ -1,14 +1,17 @@
-from typing import Any, List, Tuple, Union
+from typing import List, Tuple, Union
 import torch
 import numpy as np
 import torch.nn.functional as nnf
-from torchvision.transforms import transforms
+import cv2
 from timeit import default_timer as timer
 from common.types import CustomThread
-from model.models import yolo, mobilenet, shufflenet, BoxResult, NetResult
+from model.models import registry, BoxResult, NetResult, INPUT_SIZE, YOLO_INPUT_SIZE
 from common.utils import unpack
-from PIL import Image
-from box import Box
+from batching import BatchScheduler
+from box import Box, BoxArray
+import metrics
+import logging
+import config
 
 from model.imagenet import Imagenet
 from model.coco import Coco
@@ -17,63 +20,197 @@ BoxResults = List[Tuple[BoxResult, NetResult]]
 NetResults = List[Tuple[NetResult, NetResult]]
 PredictResults = Union[BoxResults, NetResults]
 
+log = logging.getLogger(__name__)
 
-def make_coco_predictor(model: Any, name: str):
-  def yolo_predict(img: Image.Image) -> List[BoxResult]:
-    # start = timer()
-    output = model([img], size=640)
-    # end = timer()
+crops_classified = metrics.Counter('tagger_crops_classified_total', 'Crops classified by the second stage')
+crops_skipped = metrics.Counter('tagger_crops_skipped_total',
+                                'Yolo boxes that shared a crop or were left to yolo alone')
 
-    # print(f'{name} inference took {end - start} seconds')
 
-    results = []
-    for i, (*box, conf, cls) in enumerate(output.pred[0]):
-      bbox = Box(list(map(lambda t: t.item(), box)))
-      results += [BoxResult(Coco[int(cls.item())], conf.item(), bbox)]
+def make_coco_predictor(key: str, name: str):
+  def yolo_predict_batch(imgs: List[np.ndarray]) -> List[List[BoxResult]]:
+    model = registry.get(key)
 
-    return results
+    start = timer()
+    with metrics.stage('yolo'):
+      output = model(imgs, size=YOLO_INPUT_SIZE)
+    end = timer()
+
+    log.debug(f'{name} inference took {end - start} seconds (batch of {len(imgs)})')
+
+    batch_results = []
+    for pred in output.pred:
+      results = []
+      for i, (*box, conf, cls) in enumerate(pred):
+        bbox = Box(list(map(lambda t: t.item(), box)))
+        results += [BoxResult(Coco[int(cls.item())], conf.item(), bbox)]
+      batch_results += [results]
+
+    return batch_results
+
+  scheduler = BatchScheduler(yolo_predict_batch, config.BATCH_MAX_SIZE,
+                             config.BATCH_MAX_DELAY, name)
+
+  def yolo_predict(imgs: List[np.ndarray]) -> List[List[BoxResult]]:
+    return scheduler.run_many(imgs)
   return yolo_predict
 
 
-def make_imagenet_predictor(model: Any, name: str):
-  def imagenet_predict(img: Image.Image, k: int = 1) -> List[NetResult]:
-    tensor = preprocess(img)
-    tensor = tensor.unsqueeze(0)
+def make_imagenet_predictor(key: str, name: str):
+  def imagenet_predict_batch(items: List[Tuple[torch.Tensor, int]]) -> List[List[List[NetResult]]]:
+    model = registry.get(key)
 
-    with torch.no_grad():
+    # each item holds the stacked inputs from one caller
+    tensor = torch.cat([t for t, _ in items])
+
+    with torch.no_grad(), metrics.stage('classify'):
       start = timer()
       output = model(tensor)
       end = timer()
 
-    print(f'{name} inference took {end - start} seconds')
+    log.debug(f'{name} inference took {end - start} seconds (batch of {len(tensor)})')
+
+    probabilities = nnf.softmax(output, dim=1)
+    sizes = [len(t) for t, _ in items]
+
+    batch_results = []
+    for chunk, (_, k) in zip(torch.split(probabilities, sizes), items):
+      item_results = []
+      for probs in chunk:
+        results = []
+        values, classes = torch.topk(probs, k)
+        for conf, cls in zip(values, classes):
+          results += [NetResult(Imagenet[int(cls.item())], conf.item())]
+        item_results += [results]
+      batch_results += [item_results]
 
-    results = []
-    values, classes = torch.topk(nnf.softmax(output[0], dim=0), k)
-    for conf, cls in zip(values, classes):
-      results += [NetResult(Imagenet[int(cls.item())], conf.item())]
+    return batch_results
 
-    return results
+  scheduler = BatchScheduler(imagenet_predict_batch, config.BATCH_MAX_SIZE,
+                             config.BATCH_MAX_DELAY, name)
+
+  def imagenet_predict(groups: List[List[np.ndarray]], k: int = 1) -> List[List[List[NetResult]]]:
+    # the images in each group are preprocessed on the calling thread
+    # into one tensor so that every group runs in a single forward.
+    if not any(groups):
+      return [[] for _ in groups]
+    with metrics.stage('preprocess'):
+      items = [(preprocess_batch(imgs), k) for imgs in groups if imgs]
+    outputs = iter(scheduler.run_many(items))
+    return [next(outputs) if imgs else [] for imgs in groups]
   return imagenet_predict
 
 
-preprocess = transforms.Compose([
-  transforms.Resize(256),
-  transforms.ToTensor(),
-  transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-])
+MEAN = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+STD = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+
+
+def preprocess(img: np.ndarray, size: int = INPUT_SIZE, out: torch.Tensor = None) -> torch.Tensor:
+  """
+  Resizes an RGB image to fit in a `size` x `size` square and centers
+  it with zero padding (the mean color once normalized) so that
+  images of any shape can be batched together. The result is written
+  into `out` if it's given.
+  """
+  h, w = img.shape[:2]
+  scale = size / max(w, h)
+  nw = max(1, round(w * scale))
+  nh = max(1, round(h * scale))
+  # area averaging when shrinking matches the antialiasing of PIL's resize
+  interp = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+  resized = cv2.resize(img, (nw, nh), interpolation=interp)
+
+  if out is None:
+    out = torch.zeros(3, size, size)
+  left = (size - nw) // 2
+  top = (size - nh) // 2
+
+  # the resized pixels are normalized straight into the padded tensor
+  tensor = torch.from_numpy(resized).permute(2, 0, 1)
+  out[:, top:top + nh, left:left + nw] = (tensor.float() / 255 - MEAN) / STD
+  return out
 
 
-yolo_predictor = make_coco_predictor(yolo, 'Yolo')
-mobilenet_predictor = make_imagenet_predictor(mobilenet, 'Mobilenet')
-shufflenet_predictor = make_imagenet_predictor(shufflenet, 'Shufflenet')
+def preprocess_batch(imgs: List[np.ndarray], size: int = INPUT_SIZE) -> torch.Tensor:
+  batch = torch.zeros(len(imgs), 3, size, size)
+  for img, out in zip(imgs, batch):
+    preprocess(img, size, out)
+  return batch
 
 
-def run_broad_pass(img: Image.Image) -> NetResults:
-  t1 = CustomThread(target=mobilenet_predictor, args=(img,))
-  t2 = CustomThread(target=shufflenet_predictor, args=(img,))
+yolo_predictor = make_coco_predictor('yolo', 'Yolo')
+mobilenet_predictor = make_imagenet_predictor('mobilenet', 'Mobilenet')
+shufflenet_predictor = make_imagenet_predictor('shufflenet', 'Shufflenet')
+
+
+def run_broad_pass(imgs: List[np.ndarray]) -> List[NetResults]:
+  groups = [[img] for img in imgs]
+  t1 = CustomThread(target=mobilenet_predictor, args=(groups,))
+  t2 = CustomThread(target=shufflenet_predictor, args=(groups,))
   t1.start()
   t2.start()
-  return list(zip(t1.join(), t2.join()))
+  return [list(zip(m[0], s[0])) for m, s in zip(t1.join(), t2.join())]
+
+
+def select_crops(results: List[BoxResult], limit: int) -> List[BoxResult]:
+  """
+  Returns the boxes that should be classified by the second stage,
+  at most `limit` of them. Large boxes with a high confidence are
+  picked first since they are the most likely to be recognized.
+  """
+  def score(r: BoxResult) -> float:
+    return r.bbox.area * r.conf
+
+  return sorted(results, key=score, reverse=True)[:limit]
+
+
+def plan_crops(results: List[BoxResult], shape: Tuple[int, int], limit: int) -> Tuple[List[Box], List[int]]:
+  """
+  Picks the crops of an image that are classified by the second stage
+  and returns them along with the crop each yolo box shares (or -1 for
+  boxes that are left to yolo alone). Boxes smaller than `CROP_MIN_AREA`
+  percent of the image or with an empty crop aren't classified,
+  same-class boxes that overlap by more than `CROP_MERGE_IOU` percent
+  share the crop around all of them and, with `CROP_GROUP_SIZE` set, a
+  crowd of that many boxes of one class all share the crop of its best
+  box. Every box keeps its own result so the number of instances of
+  each label stays the same.
+  """
+  groups = np.full(len(results), -1)
+  min_area = config.CROP_MIN_AREA / 100 * shape[0] * shape[1]
+  boxes = BoxArray.from_boxes([r.bbox for r in results])
+  # boxes that would crop to nothing (zero width or height once clamped
+  # to the image, like `Box.crop` does) can't be resized for the classifier
+  h, w = shape
+  x1, y1 = np.clip(np.trunc(boxes.x), 0, w), np.clip(np.trunc(boxes.y), 0, h)
+  x2, y2 = np.clip(np.trunc(boxes.xmax), 0, w), np.clip(np.trunc(boxes.ymax), 0, h)
+  eligible = np.nonzero((boxes.area >= min_area) & (x2 > x1) & (y2 > y1))[0]
+  if len(eligible) == 0:
+    return [], groups.tolist()
+
+  conf = np.asarray([results[i].conf for i in eligible])
+  classes = np.unique([results[i].label.name for i in eligible], return_inverse=True)[1].ravel()
+  candidates = boxes[eligible]
+  if config.CROP_MERGE_IOU > 0:
+    kept, crops, group = candidates.merge(conf, config.CROP_MERGE_IOU / 100, classes)
+  else:
+    kept, crops, group = np.arange(len(eligible)), candidates, np.arange(len(eligible))
+
+  # large boxes with a high confidence are picked first like `select_crops`
+  score = crops.area * conf[kept]
+  if config.CROP_GROUP_SIZE > 0:
+    remap = np.arange(len(kept))
+    for cls in np.nonzero(np.bincount(classes) >= config.CROP_GROUP_SIZE)[0]:
+      members = np.nonzero(classes[kept] == cls)[0]
+      remap[members] = members[np.argmax(score[members])]
+    group = remap[group]
+
+  used = np.unique(group)
+  order = used[np.argsort(-score[used], kind='stable')][:limit]
+  index = np.full(len(kept), -1)
+  index[order] = np.arange(len(order))
+  groups[eligible] = index[group]
+  return [crops[int(i)] for i in order], groups.tolist()
 
 
 def run_predict(img: np.ndarray) -> PredictResults:
@@ -83,37 +220,57 @@ def run_predict(img: np.ndarray) -> PredictResults:
   contain bounding boxes, and with some images there may not be any
   results at all.
 
-  :param img: The image to run predictions on.
+  :param img: The RGB image to run predictions on.
   :return: A list of prediction results
   """
+  return run_predict_batch([img])[0]
 
-  # convert BGR to RGB and load as PIL image
-  img = Image.fromarray(img[:, :, ::-1])
+
+def run_predict_batch(imgs: List[np.ndarray]) -> List[PredictResults]:
+  """
+  Runs predictions on a number of images at once. Each stage of the
+  pipeline is run for every image before moving onto the next one so
+  that the images share forward passes wherever possible.
+
+  :param imgs: The RGB images to run predictions on.
+  :return: A list of prediction results for each image
+  """
 
   # first run on yolonet to get bounding boxes and predictions
-  results = yolo_predictor(img)
-  if len(results) > 0:
-    # if yolo has found some objects in the image, we crop the
-    # original image using each of the bounding boxes returned by
-    # yolo and then pass it to shufflenet. this will give us two
-    # difference sources to make our prediction on, and will allow
-    # a wider range of objects (namely animals) to be detected due
-    # to the shufflenet using the imagenet dataset which has 1000
-    # classes vs coco's 90.
-    threads = []
-    for result in results:
-      cropped = Image.fromarray(result.bbox.crop(np.asarray(img)))
-      t = CustomThread(target=shufflenet_predictor, args=(cropped,))
-      t.start()
-      threads += [t]
-
-    outputs = unpack([t.join() for t in threads])
-    results = list(zip(results, outputs))
-  else:
-    # if no targets were found run both mobilenet and shufflenet
-    # on the entire image to hopefully catch any large features.
-    # we run on both nets here to improve regognition chance and
-    # so we can cross-reference the results for increased accuracy.
-    results = run_broad_pass(img)
+  detections = yolo_predictor(imgs)
+
+  # if yolo has found some objects in an image, we crop the
+  # original image using each of the bounding boxes returned by
+  # yolo and then pass it to shufflenet. this will give us two
+  # difference sources to make our prediction on, and will allow
+  # a wider range of objects (namely animals) to be detected due
+  # to the shufflenet using the imagenet dataset which has 1000
+  # classes vs coco's 90.
+  plans = [plan_crops(results, img.shape[:2], config.MAX_CROPS)
+           for img, results in zip(imgs, detections)]
+  # the crops are views into the images, they're only copied once
+  # they've been resized down to the classifier's input size.
+  crops = [[box.crop(img) for box in boxes] for img, (boxes, _) in zip(imgs, plans)]
+  outputs = shufflenet_predictor(crops)
+  crops_classified.inc(sum(map(len, crops)))
+  crops_skipped.inc(sum(map(len, detections)) - sum(map(len, crops)))
+
+  # if no targets were found run both mobilenet and shufflenet
+  # on the entire image to hopefully catch any large features.
+  # we run on both nets here to improve regognition chance and
+  # so we can cross-reference the results for increased accuracy.
+  broad = [img for img, results in zip(imgs, detections) if len(results) == 0]
+  broad_results = iter(run_broad_pass(broad))
+
+  batch_results = []
+  for results, (_, groups), output in zip(detections, plans, outputs):
+    if len(results) == 0:
+      batch_results += [next(broad_results)]
+      continue
+
+    # boxes without a crop of their own are paired with
+    # themselves so the yolo prediction is used on its own.
+    classified = list(unpack(output))
+    batch_results += [[(r, classified[g] if g >= 0 else r) for r, g in zip(results, groups)]]
 
-  return results
+  return batch_results
@@ -0,0 +1,76 @@
+from typing import List
+from model.detector import Detector
+from model import models
+import numpy as np
+import pytest
+import torch
+import cv2
+import os
+
+# an image from the yolov5 source tree that's downloaded with the weights
+IMAGE = models.local_path('yolov5', 'data', 'images', 'bus.jpg')
+
+
+def fake_forward(inputs: List[torch.Tensor], boxes: List[List[float]]):
+  """
+  A yolo network that records its input and predicts the given
+  (cx, cy, w, h) boxes of class 0 in letterboxed coordinates.
+  """
+  def forward(x: torch.Tensor) -> torch.Tensor:
+    inputs.append(x)
+    pred = torch.zeros(len(x), len(boxes), 85)
+    if len(boxes) > 0:
+      pred[:, :, :4] = torch.tensor(boxes)
+    pred[:, :, 4] = 0.9
+    pred[:, :, 5] = 1
+    return pred
+  return forward
+
+
+def test_letterbox_splits_padding_like_yolov5():
+  inputs = []
+  detector = Detector(fake_forward(inputs, []), 640)
+  detector([np.full((427, 640, 3), 200, dtype=np.uint8)], size=640)
+
+  # 213 rows of padding, yolov5 puts the odd one below the image
+  rows = (inputs[0][0, 0, :, 0] > 0.6).nonzero().flatten()
+  assert (rows.min().item(), rows.max().item()) == (106, 532)
+
+
+def test_boxes_are_mapped_back_onto_the_image():
+  # a 1280x854 image is halved to 640x427 with 106.5 rows of padding above
+  detector = Detector(fake_forward([], [[320, 206.5, 100, 50]]), 640)
+  pred = detector([np.zeros((854, 1280, 3), dtype=np.uint8)], size=640).pred[0]
+  assert pred[:, :4].tolist() == [[540, 150, 740, 250]]
+
+
+def iou(a: torch.Tensor, b: torch.Tensor) -> float:
+  w = (min(a[2], b[2]) - max(a[0], b[0])).clamp(min=0)
+  h = (min(a[3], b[3]) - max(a[1], b[1])).clamp(min=0)
+  inter = w * h
+  area = lambda t: (t[2] - t[0]) * (t[3] - t[1])
+  return float(inter / (area(a) + area(b) - inter))
+
+
+@pytest.fixture(scope='module')
+def hub_model():
+  if not os.path.exists(models.local_path('yolov5s.pt')) or not os.path.exists(IMAGE):
+    pytest.skip('yolov5 has not been downloaded, run `python -m model.models`')
+  return models.load_yolo()
+
+
+def test_detector_matches_hub_model(hub_model):
+  img = cv2.cvtColor(cv2.imread(IMAGE), cv2.COLOR_BGR2RGB)
+  network = hub_model.model.eval()
+  detector = Detector(lambda x: network(x), models.YOLO_INPUT_SIZE)
+
+  expected = hub_model([img], size=models.YOLO_INPUT_SIZE).pred[0].cpu()
+  actual = detector([img], size=models.YOLO_INPUT_SIZE).pred[0]
+  assert len(expected) > 0
+
+  # the hub model pads to a multiple of the stride rather than to a
+  # square, so the scores differ slightly but every box should agree.
+  for box in expected:
+    same_class = actual[actual[:, 5] == box[5]]
+    assert len(same_class) > 0
+    assert max([iou(box[:4], other[:4]) for other in same_class]) > 0.9
@@ -0,0 +1,125 @@
+from typing import List, Tuple
+from multipart import MultipartParser, MultipartError, parse_boundary, parse_header
+import pytest
+
+BOUNDARY = b'----tagger1234'
+
+
+def make_body(parts: List[Tuple[str, str, bytes]], close: bool = True) -> bytes:
+  """
+  Builds a multipart body of (name, filename, content) parts. Parts
+  without a filename are plain form fields.
+  """
+  body = b'preamble\r\n'
+  for name, filename, content in parts:
+    body += b'--' + BOUNDARY + b'\r\n'
+    disposition = f'form-data; name="{name}"'
+    if filename is not None:
+      disposition += f'; filename="{filename}"'
+    body += f'Content-Disposition: {disposition}\r\n'.encode()
+    if filename is not None:
+      body += b'Content-Type: image/jpeg\r\n'
+    body += b'\r\n' + content + b'\r\n'
+  if close:
+    body += b'--' + BOUNDARY + b'--\r\n'
+  return body
+
+
+PARTS = [
+  ('file', 'a.jpg', b'first image'),
+  ('field', None, b'not a file'),
+  # content that looks like a boundary without the line break before it
+  ('file', 'b.jpg', b'--' + BOUNDARY + b'\r\n' + b'x' * 100),
+  ('file', 'empty.jpg', b''),
+]
+
+
+def feed(parser: MultipartParser, body: bytes, chunk_size: int):
+  for i in range(0, len(body), chunk_size):
+    parser.feed(body[i:i + chunk_size])
+
+
+def files(parts: List[dict]) -> List[Tuple[str, str, str, bytes]]:
+  return [(p['name'], p['filename'], p['content_type'], bytes(p['body'])) for p in parts]
+
+
+EXPECTED = [('file', f, 'image/jpeg', c) for _, f, c in PARTS if f is not None]
+
+
+@pytest.mark.parametrize('fixed', [True, False])
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, len(BOUNDARY) + 3, 1 << 20])
+def test_parts_split_across_chunks(fixed: bool, chunk_size: int):
+  body = make_body(PARTS)
+  parser = MultipartParser(BOUNDARY, len(body) if fixed else 0)
+  feed(parser, body, chunk_size)
+  assert parser.done
+  assert files(parser.finish()) == EXPECTED
+
+
+def test_fixed_buffer_passes_parts_as_they_complete():
+  body = make_body(PARTS)
+  seen = []
+  parser = MultipartParser(BOUNDARY, len(body), lambda part: seen.append(bytes(part['body'])))
+
+  # the first part is complete once the boundary after it arrives
+  first_end = body.index(b'\r\n--' + BOUNDARY, body.index(b'first image'))
+  parser.feed(body[:first_end + len(BOUNDARY) + 4])
+  assert seen == [b'first image']
+
+  parser.feed(body[first_end + len(BOUNDARY) + 4:])
+  assert seen == [c for _, f, c in PARTS if f is not None]
+  # the bodies are views into the one buffer rather than copies
+  assert all(isinstance(p['body'], memoryview) for p in parser.finish())
+
+
+def test_growing_buffer_only_has_parts_once_finished():
+  body = make_body(PARTS)
+  seen = []
+  parser = MultipartParser(BOUNDARY, 0, seen.append)
+  feed(parser, body, 16)
+  assert seen == []
+  assert files(parser.finish()) == EXPECTED
+
+
+@pytest.mark.parametrize('fixed', [True, False])
+def test_missing_closing_boundary(fixed: bool):
+  body = make_body(PARTS, close=False)
+  parser = MultipartParser(BOUNDARY, len(body) if fixed else 0)
+  parser.feed(body)
+  assert not parser.done
+  with pytest.raises(MultipartError):
+    parser.finish()
+
+
+def test_body_larger_than_content_length():
+  body = make_body(PARTS)
+  parser = MultipartParser(BOUNDARY, len(body) - 1)
+  with pytest.raises(MultipartError):
+    feed(parser, body, 64)
+
+
+def test_invalid_delimiter():
+  parser = MultipartParser(BOUNDARY)
+  with pytest.raises(MultipartError):
+    parser.feed(b'--' + BOUNDARY + b'xx')
+
+
+def test_headers_that_are_not_utf8():
+  body = make_body([('file', 'a.jpg', b'image')]).replace(b'a.jpg', 'é.jpg'.encode('latin1'))
+  parser = MultipartParser(BOUNDARY, len(body))
+  with pytest.raises(MultipartError):
+    parser.feed(body)
+
+
+def test_parse_boundary():
+  assert parse_boundary('multipart/form-data; boundary=abc') == b'abc'
+  assert parse_boundary('multipart/form-data; boundary="a=b c"') == b'a=b c'
+  assert parse_boundary('multipart/form-data') is None
+  assert parse_boundary('application/json') is None
+
+
+def test_parse_header():
+  assert parse_header('form-data; name="file"; filename="a \\"b\\".jpg"') == \
+    ('form-data', {'name': 'file', 'filename': 'a "b".jpg'})
+  assert parse_header("form-data; filename*=UTF-8''%E2%82%AC.jpg") == \
+    ('form-data', {'filename': '€.jpg'})
@@ -0,0 +1,119 @@
+from typing import List, Optional
+from dataclasses import dataclass
+from multiprocessing import Value
+import config
+import torch
+import os
+
+# the most models that run at the same time within a process,
+# the batch schedulers of every model can all be running at once.
+PARALLEL_MODELS = max(1, config.PARALLEL_MODELS)
+
+
+@dataclass
+class ThreadBudget:
+  """
+  The share of the host's cores given to a tagger worker.
+  """
+  # the cores the worker runs on
+  cores: List[int]
+  # the threads torch uses within a single op
+  intra_op: int
+  # the threads torch uses to run independent ops in parallel
+  inter_op: int
+
+
+# the budget applied to this process
+current: Optional[ThreadBudget] = None
+
+
+def available_cores() -> List[int]:
+  if hasattr(os, 'sched_getaffinity'):
+    return sorted(os.sched_getaffinity(0))
+  return list(range(os.cpu_count() or 1))
+
+
+def split_cores(cores: List[int], parts: int) -> List[List[int]]:
+  """
+  Splits `cores` into `parts` contiguous shares whose sizes differ by at
+  most one. When there are fewer cores than parts the cores are shared.
+  """
+  if parts <= len(cores):
+    size, extra = divmod(len(cores), parts)
+    shares, start = [], 0
+    for i in range(parts):
+      end = start + size + (1 if i < extra else 0)
+      shares += [cores[start:end]]
+      start = end
+    return shares
+
+  return [[cores[i % len(cores)]] for i in range(parts)]
+
+
+def plan(cores: List[int], workers: int = 1, index: int = 0, threads: int = 0,
+         inter_op: int = 1, parallel_models: int = PARALLEL_MODELS) -> ThreadBudget:
+  """
+  Plans the budget of worker `index` out of `workers` sharing `cores`.
+  Unless `threads` is given, each of the models that can run at once in
+  the worker gets an equal part of its cores so they don't oversubscribe.
+  """
+  share = split_cores(cores, workers)[index % workers]
+  if threads <= 0:
+    threads = max(1, len(share) // parallel_models)
+  return ThreadBudget(share, threads, max(1, inter_op))
+
+
+def apply(budget: ThreadBudget, pin: bool = False):
+  global current
+  if pin and hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(0, budget.cores)
+
+  torch.set_num_threads(budget.intra_op)
+  try:
+    torch.set_num_interop_threads(budget.inter_op)
+  except RuntimeError:
+    # the inter-op pool can only be sized before it's first used,
+    # which has already happened in processes forked after loading.
+    pass
+
+  current = budget
+
+
+#
+# Tagger Workers
+#
+
+# the number of executor processes that have been given a budget
+_process_count = Value('i', 0)
+
+
+def configure() -> ThreadBudget:
+  """
+  Applies this worker's share of the host, going by the number of
+  tagger workers on the host and this worker's index among them.
+  """
+  budget = plan(available_cores(), config.WORKERS_PER_HOST, config.WORKER_INDEX,
+                config.TORCH_THREADS, config.TORCH_INTEROP_THREADS)
+  apply(budget, config.PIN_CORES)
+  return budget
+
+
+def configure_process(processes: int = None, index: int = None):
+  """
+  Splits the worker's share between `processes` processes and applies
+  the share of process `index`. Used without arguments as the initializer
+  of the inference pool, where indices are handed out as processes start.
+  """
+  global _process_count
+  if processes is None:
+    processes = config.EXECUTOR_WORKERS
+    with _process_count.get_lock():
+      index = _process_count.value
+      _process_count.value += 1
+  else:
+    # any pool started by this process numbers its own processes
+    _process_count = Value('i', 0)
+
+  cores = current.cores if current is not None else available_cores()
+  budget = plan(cores, processes, index, config.TORCH_THREADS, config.TORCH_INTEROP_THREADS)
+  apply(budget, config.PIN_CORES)